@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+import numpy as np
+import os
+import sys
+import time
+'''
+Stand-in for the fd3 binary, for benchmarking without real data. Reads an
+.in file from stdin like fd3, sleeps according to a cost model and writes
+outputs of the right shape: the used part of the .obs file and its .mod,
+and the .mod/.res/.rvs/.log files named on the last line.
+
+Cost model (seconds): FAKE_FD3_OVERHEAD + FAKE_FD3_COST * pixels * epochs,
+both read from the environment. Progress lines 'run iteration chi2 orbit'
+are printed to stdout while it runs, and the last one of every run is
+written to the .log file. chi2 levels off after FAKE_FD3_CONVERGE steps
+(default: never). Like fd3, it writes no outputs when it is terminated.
+'''
+
+OVERHEAD = float(os.environ.get('FAKE_FD3_OVERHEAD', 0.05))
+COST = float(os.environ.get('FAKE_FD3_COST', 2e-7))
+CONVERGE = int(os.environ.get('FAKE_FD3_CONVERGE', 0))
+
+
+def main():
+    lines = [line.split() for line in sys.stdin if line.strip()]
+    first, last = lines[0], lines[-1]
+    obsfile, lnmin, lnmax, usedfile = \
+        first[0], float(first[1]), float(first[2]), first[3]
+    epochs = [line for line in lines[1:] if len(line) == 5]
+    orbit = [float(x) for x in lines[-2][0::2]]
+    n_runs, n_iter = int(last[0]), int(last[1])
+    modfile, resfile, rvsfile, logfile = last[3:7]
+
+    # read the rows in range
+    with open(obsfile, 'r') as f:
+        rows = [line for line in f
+                if not line.startswith('#') and line.strip() and
+                lnmin <= float(line.split(None, 1)[0]) <= lnmax]
+    data = np.loadtxt(rows, ndmin=2)
+    n_pixels = len(data)
+
+    # pretend to work, reporting a decreasing chi2
+    runtime = OVERHEAD + COST * n_pixels * len(epochs)
+    steps = max(n_runs, 1) * 4
+    chi2 = 10. * n_pixels
+    log = []
+    for run in range(max(n_runs, 1)):
+        for i in range(4):
+            time.sleep(runtime / steps)
+            if not CONVERGE or run * 4 + i < CONVERGE:
+                chi2 *= .7
+            line = '{} {} {:.6f} {}'.format(
+                run + 1, (i + 1) * n_iter // 4, chi2,
+                ' '.join(repr(x) for x in orbit))
+            print(line)
+            sys.stdout.flush()
+        log.append(line)
+
+    lnw = data[:, 0]
+    flux = data[:, 1:]
+    model_a = flux.mean(axis=1)
+    model_b = np.ones(n_pixels)
+    mod = np.array([lnw, model_a, model_b]).transpose()
+
+    with open(usedfile, 'w') as f:
+        f.write('# {} X {}\n'.format(data.shape[1], n_pixels))
+        np.savetxt(f, data, fmt='%.10f')
+    np.savetxt(usedfile + '.mod', mod, fmt='%.10f')
+    np.savetxt(modfile, mod, fmt='%.10f')
+    np.savetxt(resfile, np.column_stack([lnw, flux - model_a[:, None]]),
+               fmt='%.10f')
+    with open(rvsfile, 'w') as f:
+        for epoch in epochs:
+            f.write('{} 0.0 0.0\n'.format(epoch[0]))
+    with open(logfile, 'w') as f:
+        f.write('\n'.join(log) + '\n')
+
+
+if __name__ == '__main__':
+    main()
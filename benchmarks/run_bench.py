@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import numpy as np
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import threading
+'''
+Timed benchmark scenarios for the split -> fd3 -> stitch pipeline, on
+synthetic data (synth.py) and with a stand-in fd3 binary (fake_fd3.py):
+
+    split     setBounds on the master .obs file
+    schedule  run_fd3 on the split .in files
+    stitch    average_overlap and overlap_add on .obs.mod segments
+    normalize fd3_norm.normalize_chunked in place on the memory-mapped
+              epoch stack, checked against one normalize pass
+
+Every scenario reports its wall time, throughput and peak memory
+(growth of the resident set size during the scenario, and maximum RSS of
+the fd3 child processes for 'schedule'). Results are printed and can be saved
+as JSON to compare between versions.
+
+    python benchmarks/run_bench.py --pixels 200000 --epochs 31 --segments 50
+'''
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+import fd3_cache  # noqa: E402
+import fd3_helper  # noqa: E402
+import fd3_loader  # noqa: E402
+import fd3_norm  # noqa: E402
+import synth  # noqa: E402
+
+
+def rss():
+    # current resident set size in bytes (Linux), or the maximum so far
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def measure(func, *args, **kwargs):
+    '''
+    Runs func and returns its result, wall time and peak memory above the
+    memory in use before the call. Memory is sampled from a thread, which
+    unlike tracemalloc doesn't slow down the code being measured.
+    '''
+    base = rss()
+    peak = [base]
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(0.002):
+            peak[0] = max(peak[0], rss())
+
+    sampler = threading.Thread(target=sample)
+    sampler.start()
+    tic = time.perf_counter()
+    try:
+        result = func(*args, **kwargs)
+    finally:
+        wall = time.perf_counter() - tic
+        done.set()
+        sampler.join()
+    return result, wall, max(peak[0], rss()) - base
+
+
+def bench_split(args):
+    synth.write_splits('splits.txt', args.segments)
+    _, wall, peak = measure(fd3_helper.setBounds, 'synth.in', 'splits.txt')
+    return {'scenario': 'split', 'wall': wall, 'peak_bytes': peak,
+            'rows_per_s': args.pixels / wall}
+
+
+def bench_schedule(args):
+    os.environ['FAKE_FD3_OVERHEAD'] = str(args.overhead)
+    os.environ['FAKE_FD3_COST'] = str(args.cost)
+    filenames = sorted(name for name in os.listdir('.')
+                       if name.startswith('synth_split_') and
+                       name.endswith('.in'))
+    statuses, wall, peak = measure(
+        fd3_helper.run_fd3, filenames, processes=args.processes,
+        use_cache=False)
+    busy = sum(status['runtime'] for status in statuses)
+    cores = args.processes or os.cpu_count()
+    child_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+    return {'scenario': 'schedule', 'wall': wall, 'peak_bytes': peak,
+            'child_peak_rss': child_rss, 'jobs': len(statuses),
+            'failed': sum(not status['ok'] for status in statuses),
+            'jobs_per_s': len(statuses) / wall,
+            'utilisation': busy / (wall * cores)}
+
+
+def bench_stitch(args):
+    names = synth.write_mods(args.pixels, args.segments)
+
+    def overlap_add(names):
+        fd3_helper.write_stitched(*fd3_helper.overlap_add(names))
+
+    results = []
+    for label, func in (('average_overlap', fd3_helper.average_overlap),
+                        ('overlap_add', overlap_add)):
+        # both start from the text files
+        fd3_loader.clear_cache()
+        _, wall, peak = measure(func, names)
+        results.append({'scenario': 'stitch:' + label, 'wall': wall,
+                        'peak_bytes': peak, 'pixels_per_s': args.pixels / wall})
+    return results
+
+
+def bench_normalize(args):
+    # the flux of synth.obs as a memory-mapped (epochs x pixels) stack,
+    # normalised in place in about 8 chunks
+    flux = np.ascontiguousarray(fd3_loader.load_table('synth.obs')[:, 1:].T)
+    expected = fd3_norm.normalize(flux, method='continuum')
+    stack = np.lib.format.open_memmap('stack.npy', mode='w+',
+                                      dtype=float, shape=flux.shape)
+    stack[:] = flux
+    chunk = max(args.pixels // 8, fd3_norm.BLOCK)
+    _, wall, peak = measure(fd3_norm.normalize_chunked, stack,
+                            method='continuum', chunk=chunk)
+    error = float(np.max(np.abs(stack - expected)))
+    if error != 0:
+        raise AssertionError('chunked normalisation differs from one pass '
+                             'by up to {}'.format(error))
+    return {'scenario': 'normalize', 'wall': wall, 'peak_bytes': peak,
+            'pixels_per_s': args.pixels / wall, 'max_error': error}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmarks of the split -> fd3 -> stitch pipeline')
+    parser.add_argument('--pixels', type=int, default=100000)
+    parser.add_argument('--epochs', type=int, default=31)
+    parser.add_argument('--segments', type=int, default=20)
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--overhead', type=float, default=0.05,
+                        help='fake fd3 start-up time (s)')
+    parser.add_argument('--cost', type=float, default=2e-7,
+                        help='fake fd3 time per pixel per epoch (s)')
+    parser.add_argument('--scenarios',
+                        default='split,schedule,stitch,normalize')
+    parser.add_argument('--output', help='save the results as JSON')
+    parser.add_argument('--keep', action='store_true',
+                        help="don't remove the working directory")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='fd3-bench-')
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    # keep the caches inside the working directory, so every benchmark
+    # starts cold and nothing is left behind
+    fd3_loader.CACHE_DIR = os.path.join(workdir, 'cache')
+    fd3_cache.RESULTS_DIR = os.path.join(workdir, 'cache', 'results')
+
+    try:
+        print('generating {} pixels x {} epochs in {}'.format(
+            args.pixels, args.epochs, workdir))
+        t = synth.write_obs('synth.obs', args.pixels, args.epochs)
+        synth.write_in('synth.in', 'synth.obs', t)
+        os.symlink(os.path.join(BENCH_DIR, 'fake_fd3.py'), 'fd3')
+
+        scenarios = args.scenarios.split(',')
+        results = []
+        if 'split' in scenarios or 'schedule' in scenarios:
+            results.append(bench_split(args))
+        if 'schedule' in scenarios:
+            results.append(bench_schedule(args))
+        if 'stitch' in scenarios:
+            results.extend(bench_stitch(args))
+        if 'normalize' in scenarios:
+            results.append(bench_normalize(args))
+    finally:
+        os.chdir(cwd)
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print()
+    for result in results:
+        print('{:28s} {:8.3f} s  {:8.1f} MB peak  {}'.format(
+            result['scenario'], result['wall'], result['peak_bytes'] / 2**20,
+            '  '.join('{}={:.4g}'.format(key, value)
+                      for key, value in result.items()
+                      if key not in ('scenario', 'wall', 'peak_bytes'))))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'args': vars(args), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
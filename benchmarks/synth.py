@@ -0,0 +1,137 @@
+import numpy as np
+'''
+Generator of synthetic fd3 input: a master .obs file with a two-component
+binary spectrum, the matching .in file, and .obs.mod segments like fd3
+writes them, for the benchmarks in this directory.
+
+Both components have a flat continuum with Gaussian absorption lines. Every
+epoch shifts them on the ln(wavelength) grid by their orbital radial
+velocity, so the .obs file has the same structure as real data.
+'''
+
+C = 299792.458  # km/s
+
+# orbit written to the .in file and used to shift the components
+PERIOD = 1.95026
+T0 = 2420055.511
+K1 = 163.52
+K2 = 199.
+LIGHT = (.67, .33)
+
+
+def ln_grid(n_pixels, lower=4000, upper=6850):
+    return np.linspace(np.log(lower), np.log(upper), n_pixels)
+
+
+def line_list(n_lines, lower, upper, seed):
+    # random line centres (ln wavelength), depths and widths (in pixels of
+    # the ln grid)
+    rng = np.random.default_rng(seed)
+    centres = rng.uniform(np.log(lower), np.log(upper), n_lines)
+    depths = rng.uniform(.05, .6, n_lines)
+    widths = rng.uniform(1e-5, 8e-5, n_lines)
+    return centres, depths, widths
+
+
+def component(lnw, lines, shift=0.):
+    # continuum of 1 with absorption lines, Doppler shifted by shift (v/c)
+    flux = np.ones(len(lnw))
+    for centre, depth, width in zip(*lines):
+        centre = centre + shift
+        # only evaluate the line within 6 sigma
+        lo, hi = np.searchsorted(lnw, [centre - 6 * width, centre + 6 * width])
+        flux[lo:hi] -= depth * np.exp(
+            -0.5 * ((lnw[lo:hi] - centre) / width)**2)
+    return flux
+
+
+def epochs(n_epochs, seed=0):
+    rng = np.random.default_rng(seed)
+    return np.sort(2458265. + rng.uniform(0, 70, n_epochs))
+
+
+def radial_velocities(t):
+    phase = 2 * np.pi * (t - T0) / PERIOD
+    return K1 * np.sin(phase), -K2 * np.sin(phase)
+
+
+def write_obs(filename, n_pixels, n_epochs, lower=4000, upper=6850,
+              n_lines=None, noise=.005, seed=0):
+    '''
+    Writes a master .obs file with n_pixels rows and n_epochs flux columns.
+    Returns the epochs.
+    '''
+    if n_lines is None:
+        n_lines = max(n_pixels // 200, 1)
+    lnw = ln_grid(n_pixels, lower, upper)
+    lines_a = line_list(n_lines, lower, upper, seed + 1)
+    lines_b = line_list(n_lines, lower, upper, seed + 2)
+    t = epochs(n_epochs, seed)
+    va, vb = radial_velocities(t)
+    rng = np.random.default_rng(seed + 3)
+
+    data = np.empty((n_pixels, n_epochs + 1))
+    data[:, 0] = lnw
+    for i in range(n_epochs):
+        data[:, i + 1] = (LIGHT[0] * component(lnw, lines_a, va[i] / C) +
+                          LIGHT[1] * component(lnw, lines_b, vb[i] / C) +
+                          rng.normal(0, noise, n_pixels))
+
+    with open(filename, 'w') as f:
+        f.write('# {} X {}\n'.format(n_epochs + 1, n_pixels))
+        np.savetxt(f, data, fmt='%.10f')
+    return t
+
+
+def write_in(filename, obsfile, t, lower=4000, upper=6850, base='synth'):
+    # .in file laid out like sig_aql.in, including the trailing line that
+    # setBounds expects after the output line
+    with open(filename, 'w') as f:
+        f.write('  '.join([obsfile, repr(float(np.log(lower))),
+                           repr(float(np.log(upper))),
+                           base + '_used.obs', '1', '1', '0']) + '\n')
+        f.write('\n')
+        for ti in t:
+            f.write('{:.12f} 0 1 {} {}\n'.format(ti, *LIGHT))
+        f.write('\n\n')
+        f.write('1 0     1 0    0 0    0 0    0 0    0 0\n\n')
+        f.write('{} 0     {} 0    0 0      176.293267 0     {} 0     {} 0'
+                '      0 0\n\n'.format(PERIOD, T0, K1, K2))
+        f.write('10  1000  0.001  {0}.mod  {0}.res  {0}.rvs  {0}.log\n'
+                .format(base))
+        f.write('  \n')
+
+
+def write_splits(filename, n_segments, lower=4000, upper=6850):
+    # equally spaced in ln(wavelength), so all segments hold as many pixels
+    splits = np.exp(np.linspace(np.log(lower), np.log(upper),
+                                n_segments + 1)[1:-1])
+    np.savetxt(filename, splits)
+    return splits
+
+
+def write_mods(n_pixels, n_segments, overlap=20, lower=4000, upper=6850,
+               base='synth_used', seed=0):
+    '''
+    Writes n_segments .obs.mod files (ln wavelength, component A, component
+    B) that cover the grid with overlap pixels shared between neighbours,
+    like the output of fd3 on the files made by setBounds.
+    Returns the file names, sorted.
+    '''
+    lnw = ln_grid(n_pixels, lower, upper)
+    a = component(lnw, line_list(max(n_pixels // 200, 1), lower, upper,
+                                 seed + 1))
+    b = component(lnw, line_list(max(n_pixels // 200, 1), lower, upper,
+                                 seed + 2))
+    edges = np.linspace(0, n_pixels, n_segments + 1).astype(int)
+    digits = len(str(n_segments))
+
+    names = []
+    for k in range(n_segments):
+        lo = max(edges[k] - overlap // 2, 0)
+        hi = min(edges[k + 1] + overlap - overlap // 2, n_pixels)
+        name = '{}_{:0{}d}.obs.mod'.format(base, k + 1, digits)
+        np.savetxt(name, np.array([lnw[lo:hi], a[lo:hi], b[lo:hi]]).transpose(),
+                   fmt='%.10f')
+        names.append(name)
+    return names
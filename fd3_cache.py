@@ -0,0 +1,163 @@
+import hashlib
+import os
+import shutil
+import time
+from fd3_loader import CACHE_DIR
+'''
+v1.0
+18/10/2026
+Content-addressed cache of fd3 results. The key of a segment is a hash of
+everything that determines its result: the effective .in file (range,
+epochs, light factors, orbit and iteration settings, but not the output
+names), the .obs data it reads and the fd3 binary. Moving one split point
+then only changes the keys of the segments next to it, and all other
+segments are copied from the cache instead of being run again.
+
+Every entry is a directory with the outputs of one segment. The cache is
+kept below RESULTS_CACHE_SIZE bytes by removing the least recently used
+entries.
+'''
+
+RESULTS_DIR = os.path.join(CACHE_DIR, 'results')
+RESULTS_CACHE_SIZE = 10 * 1024**3  # bytes
+
+# names of the outputs of a segment inside a cache entry, in the order of
+# fd3_helper.fd3_outputs
+OUTPUT_ROLES = ['used.obs', 'used.obs.mod', 'mod', 'res', 'rvs', 'log', 'out']
+
+_file_digests = {}
+
+
+def file_digest(path):
+    # sha1 of the content of a file, remembered per path, size and mtime so
+    # large master files are only read once per process
+    st = os.stat(path)
+    stamp = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+    if stamp not in _file_digests:
+        sha = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+        _file_digests[stamp] = sha.hexdigest()
+    return _file_digests[stamp]
+
+
+def segment_key(infile, binary='fd3'):
+    '''
+    Cache key of the segment described by infile. Output file names are
+    left out, so renumbered segments still hit the cache.
+    '''
+    with open(infile, 'r') as f:
+        lines = [line.split() for line in f if line.strip()]
+
+    sha = hashlib.sha1()
+    # obs file, range, used obs output and component switches
+    first = lines[0]
+    sha.update(' '.join(first[1:3] + first[4:]).encode())
+    sha.update(file_digest(first[0]).encode())
+    # epochs, light factors and orbits
+    for line in lines[1:-1]:
+        sha.update(b'\n' + ' '.join(line).encode())
+    # restarts, iterations and tolerance
+    sha.update(b'\n' + ' '.join(lines[-1][:3]).encode())
+    if os.path.exists(binary):
+        st = os.stat(binary)
+        sha.update('\n{} {}'.format(st.st_size, st.st_mtime_ns).encode())
+    return sha.hexdigest()
+
+
+def contains(key, cache_dir=None):
+    # whether the outputs of key are cached
+    if cache_dir is None:
+        cache_dir = RESULTS_DIR
+    return os.path.isdir(os.path.join(cache_dir, key))
+
+
+def fetch(key, outputs, cache_dir=None):
+    '''
+    Copies the cached outputs of key to the paths in outputs (see
+    fd3_helper.fd3_outputs). Returns False when the key isn't cached.
+    '''
+    if cache_dir is None:
+        cache_dir = RESULTS_DIR
+    entry = os.path.join(cache_dir, key)
+    if not os.path.isdir(entry):
+        return False
+
+    for role, path in zip(OUTPUT_ROLES, outputs):
+        cached = os.path.join(entry, role)
+        if os.path.exists(cached):
+            shutil.copyfile(cached, path)
+    os.utime(entry)  # mark as recently used
+    return True
+
+
+def store(key, outputs, cache_dir=None, max_size=None):
+    # stores the outputs of a finished segment under key
+    if cache_dir is None:
+        cache_dir = RESULTS_DIR
+    if max_size is None:
+        max_size = RESULTS_CACHE_SIZE
+
+    entry = os.path.join(cache_dir, key)
+    if os.path.isdir(entry):
+        return
+
+    # fill a temporary directory first, so a half written entry is never
+    # mistaken for a result
+    tmp = '{}.{}.tmp'.format(entry, os.getpid())
+    try:
+        os.makedirs(tmp, exist_ok=True)
+        for role, path in zip(OUTPUT_ROLES, outputs):
+            if os.path.exists(path):
+                shutil.copyfile(path, os.path.join(tmp, role))
+        os.rename(tmp, entry)
+    except OSError:
+        # another process stored the same key first, or the disk is full
+        shutil.rmtree(tmp, ignore_errors=True)
+        return
+
+    evict(cache_dir, max_size)
+
+
+def entry_size(entry):
+    return sum(os.path.getsize(os.path.join(entry, name))
+               for name in os.listdir(entry))
+
+
+def evict(cache_dir=None, max_size=None):
+    # removes least recently used entries until the cache fits in max_size
+    if cache_dir is None:
+        cache_dir = RESULTS_DIR
+    if max_size is None:
+        max_size = RESULTS_CACHE_SIZE
+
+    try:
+        names = os.listdir(cache_dir)
+    except OSError:
+        return
+
+    entries = []
+    for name in names:
+        entry = os.path.join(cache_dir, name)
+        if name.endswith('.tmp'):
+            # left behind by a crashed run
+            if os.path.getmtime(entry) < time.time() - 24 * 3600:
+                shutil.rmtree(entry, ignore_errors=True)
+            continue
+        try:
+            entries.append((os.path.getmtime(entry), entry_size(entry), entry))
+        except OSError:
+            continue
+
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    for _, size, entry in entries:
+        if total <= max_size:
+            break
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+
+
+def clear_cache(cache_dir=None):
+    evict(cache_dir, 0)
@@ -1,9 +1,25 @@
 import numpy as np
 import glob
+import itertools
+import functools
+import subprocess
+import threading
+import time
 import os
+import shutil
+import tempfile
 import matplotlib.pyplot as plt
+from matplotlib.collections import PolyCollection
+from matplotlib.transforms import blended_transform_factory
 import progressbar
 import multiprocessing as mp
+from fd3_loader import load_table, save_stitched, RESULTS_SUFFIX
+import fd3_cache
+import fd3_index
+import fd3_norm
+import fd3_trace
+import fd3_queue
+import fd3_progress
 '''
 v1.0
 06/11/2018
@@ -19,6 +35,44 @@ Now takes the (linearly) weighted average of the overlaps.
 v1.2
 21/11/2018
 Now uses multithreading to speed up fd3 processing.
+
+v1.3
+18/10/2026
+Stitching preallocates the output spectra and writes every segment in place,
+instead of growing the arrays with np.append.
+New overlap_add stitcher: all segments are accumulated on one shared
+ln(wavelength) grid with pluggable weight kernels (linear, cosine, S/N).
+Parsed .mod files are cached in binary form (see fd3_loader.py).
+fd3 jobs are scheduled largest first, with timeouts and retries, and report
+their exit status. Results of unchanged segments are reused from a cache
+(see fd3_cache.py).
+Every stage is timed, the timings are written as a JSON summary and a Chrome
+trace (see fd3_trace.py).
+fd3 can also run on several machines through a work queue on a shared
+filesystem (see fd3_queue.py).
+fd3 output is followed live, and jobs can be stopped early when their chi2
+has converged or diverges (see fd3_progress.py).
+The stitched spectra are saved as one binary .npz file, which file2figure
+can open; the text files are optional.
+Segments can be warm-started from the best fit of a previous run or of
+their neighbours, with smaller simplex steps and fewer restarts.
+fd3 jobs run in their own scratch directories (optionally on /dev/shm) with
+the .in text piped to fd3, and only their outputs are moved back. Outputs,
+.obs slices and stitched spectra are named after the .in file instead of
+sig_aql_* and Sig_Aql_*.
+The .res/.rvs/.log outputs of all segments are collected in one columnar
+.npz store (see fd3_results.py).
+Runs, segments and their files are recorded in an SQLite run index (see
+fd3_index.py); finished segments are reused from it and clean() only
+removes the files it lists.
+Split points can be placed automatically in the flattest continuum of the
+disentangled spectrum (line_free_splits), and reviewed in PointBrowser.
+The number of segments and their overlap can be autotuned from probe runs
+of fd3 (see fd3_tune.py).
+Segment offsets in stitching and the scaling in PointBrowser use fd3_norm.py,
+like file2figure.
+PointBrowser plots a min/max envelope of the visible part of the spectrum and
+blits the split markers, so it stays responsive for large spectra.
 '''
 
 
@@ -29,10 +83,12 @@ class PointBrowser(object):
     Press 'w' to save points.
     """
 
-    def __init__(self, fig, w, f1, f2, filepath, width):
+    def __init__(self, fig, w, f1, f2, filepath, width, splits=None):
 
         self.lastind = 0
-        if width != 0:
+        if splits is not None:
+            self.vertical_x_cen = sorted(splits)
+        elif width != 0:
             self.vertical_x_cen = list(np.arange(4000, 6850, width))
         else:
             self.vertical_x_cen = []
@@ -50,6 +106,18 @@ class PointBrowser(object):
         self.knot_width = 0.25
         self.knot_half_width = self.knot_width / 2
 
+        # the split markers are one collection, drawn over a cached
+        # background (blitting), so adding or removing a marker doesn't
+        # redraw the spectra
+        self.ax = plt.gca()
+        self.background = None
+        self.knots = PolyCollection(
+            [], facecolors='red', alpha=0.3, animated=True,
+            transform=blended_transform_factory(
+                self.ax.transData, self.ax.transAxes))
+        self.ax.add_collection(self.knots, autolim=False)
+        self.fig.canvas.mpl_connect('draw_event', self.ondraw)
+
         plt.title('.in-file splitter')
         self.raw_plot()
         plt.xlim([4000, 6850])
@@ -57,11 +125,37 @@ class PointBrowser(object):
         self.update()
 
     def raw_plot(self):
-
-        plt.plot(self.wavelength, self.flux1 / np.mean(self.flux1[0:20]),
-                 picker=5)
-        plt.plot(self.wavelength, self.flux2 / np.mean(self.flux2[0:20]),
-                 picker=5)
+        # only a min/max envelope of the part of the spectrum in view is
+        # plotted, at about one point per screen pixel; it is recomputed
+        # when zooming or panning
+        self.norm1, self.norm2 = fd3_norm.scale_window(
+            [self.flux1, self.flux2], fd3_norm.EDGE)
+
+        self.line1, = plt.plot([], [], picker=5)
+        self.line2, = plt.plot([], [], picker=5)
+
+        lo = min(np.min(self.norm1), np.min(self.norm2))
+        hi = max(np.max(self.norm1), np.max(self.norm2))
+        margin = 0.05 * (hi - lo)
+        plt.ylim([lo - margin, hi + margin])
+
+        self.ax.callbacks.connect('xlim_changed', self.onzoom)
+
+    def onzoom(self, ax):
+        lo, hi = ax.get_xlim()
+        n_bins = max(int(ax.bbox.width), 100)
+        self.line1.set_data(
+            *decimate_minmax(self.wavelength, self.norm1, lo, hi, n_bins))
+        self.line2.set_data(
+            *decimate_minmax(self.wavelength, self.norm2, lo, hi, n_bins))
+        # the new background is cached in ondraw
+        self.background = None
+        self.fig.canvas.draw_idle()
+
+    def ondraw(self, event):
+        # cache the figure without markers, then draw them on top
+        self.background = self.fig.canvas.copy_from_bbox(self.ax.bbox)
+        self.ax.draw_artist(self.knots)
 
     def onpress(self, event):
         '''
@@ -121,25 +215,51 @@ class PointBrowser(object):
     def update(self):
         if self.lastind is None:
             return
-        try:
-            self.knots.remove()
-        except:
-            pass
-        try:
-            for i in self.knots:
-                i.remove()
-        except:
-            pass
 
-        self.knots = []
-        for i in self.vertical_x_cen:
-            self.knot = plt.axvspan(
-                i - self.knot_half_width,
-                i + self.knot_half_width,
-                alpha=0.3, color='red')
-            self.knots.append(self.knot)
+        # one rectangle per split point, spanning the height of the axes
+        x = np.asarray(self.vertical_x_cen, dtype=float)
+        verts = np.empty((len(x), 4, 2))
+        verts[:, :, 0] = x[:, None] + self.knot_half_width * np.array(
+            [-1, 1, 1, -1])
+        verts[:, :, 1] = [0, 0, 1, 1]
+        self.knots.set_verts(verts)
+
+        if self.background is None:
+            self.fig.canvas.draw_idle()
+        else:
+            self.fig.canvas.restore_region(self.background)
+            self.ax.draw_artist(self.knots)
+            self.fig.canvas.blit(self.ax.bbox)
+
 
-        self.fig.canvas.draw()
+def decimate_minmax(x, y, lo, hi, n_bins):
+    '''
+    Reduces the part of (x, y) with lo <= x <= hi to the minimum and maximum
+    of each of n_bins bins, in their original order, so the plotted line
+    looks the same as the full one at a resolution of n_bins pixels.
+    '''
+    start, stop = np.searchsorted(x, [lo, hi])
+    # one point outside the view on both sides, so lines reach the edges
+    start = max(start - 1, 0)
+    stop = min(stop + 1, len(x))
+    x = x[start:stop]
+    y = y[start:stop]
+    if len(x) <= 2 * n_bins:
+        return x, y
+
+    per_bin = len(x) // n_bins
+    m = per_bin * n_bins
+    xb = x[:m].reshape(n_bins, per_bin)
+    yb = y[:m].reshape(n_bins, per_bin)
+    imin = yb.argmin(axis=1)
+    imax = yb.argmax(axis=1)
+    first = np.minimum(imin, imax)
+    second = np.maximum(imin, imax)
+    rows = np.arange(n_bins)
+
+    xd = np.column_stack([xb[rows, first], xb[rows, second]]).ravel()
+    yd = np.column_stack([yb[rows, first], yb[rows, second]]).ravel()
+    return np.concatenate([xd, x[m:]]), np.concatenate([yd, y[m:]])
 
 
 def load_data(filename):
@@ -148,7 +268,7 @@ def load_data(filename):
     Data should be structured in 3 columns with wavelength (in Å) in first
     column, and disentangled fluxes in the second and third columns
     '''
-    h = np.loadtxt(filename).transpose()
+    h = load_table(filename).transpose()
     flux1 = h[1]
     flux2 = h[2]
 
@@ -187,14 +307,40 @@ def picker(spec_directory):
     splitchoice = input("Generate equally spaced split points? (Y/N): ")
     while splitchoice not in ('Y', 'y', 'N', 'n'):
         splitchoice = input("Generate equally spaced split points? (Y/N): ")
+    splits = None
     if splitchoice == 'Y' or splitchoice == 'y':
         width = int(input("\nSplit width: "))
     else:
         width = 0
 
+        # or split points with equal cost per segment
+        splitchoice = input("Generate cost-balanced split points? (Y/N): ")
+        while splitchoice not in ('Y', 'y', 'N', 'n'):
+            splitchoice = input(
+                "Generate cost-balanced split points? (Y/N): ")
+        if splitchoice == 'Y' or splitchoice == 'y':
+            print("\n### Select .obs file ###\n")
+            obsfile = select_obs_file(spec_directory)
+            n_segments = int(input("\nNumber of segments: "))
+            splits = list(balanced_splits(obsfile, n_segments))
+            print("saved {} split points to 'splits.txt'".format(len(splits)))
+        else:
+            # or split points in the flattest continuum near equal cost
+            splitchoice = input("Place split points in line-free "
+                                "continuum? (Y/N): ")
+            while splitchoice not in ('Y', 'y', 'N', 'n'):
+                splitchoice = input("Place split points in line-free "
+                                    "continuum? (Y/N): ")
+            if splitchoice == 'Y' or splitchoice == 'y':
+                n_segments = int(input("\nNumber of segments: "))
+                splits = list(line_free_splits(wavelength, flux1, flux2,
+                                               n_segments))
+                print("saved {} split points to 'splits.txt'".format(
+                    len(splits)))
+
     # initiate interactive splitpoint browser
     browser = PointBrowser(
-        fig, wavelength, flux1, flux2, spec_directory, width)
+        fig, wavelength, flux1, flux2, spec_directory, width, splits)
 
     fig.canvas.mpl_connect('button_press_event', browser.onpick)
     fig.canvas.mpl_connect('key_press_event', browser.onpress)
@@ -202,6 +348,142 @@ def picker(spec_directory):
     plt.show()
 
 
+def balanced_splits(obsfile, n_segments, lower=4000, upper=6850,
+                    pixel_cost=None, filename='splits.txt'):
+    '''
+    Places the split points between lower and upper (in Å) so that each of
+    the n_segments segments holds the same number of pixels of the .obs
+    file. On the ln(wavelength) grid equal widths in Å don't have equal
+    pixel counts, so equally spaced splits give uneven fd3 run times.
+    pixel_cost (one value per row of the .obs file, e.g. from measured fd3
+    run times) balances the total cost per segment instead.
+    The split points are saved to filename like the 'w' key of PointBrowser
+    does, and returned.
+    '''
+    w = np.exp(load_table(obsfile)[:, 0])
+    inside = (w >= lower) & (w <= upper)
+
+    if pixel_cost is None:
+        cost = np.ones(np.count_nonzero(inside))
+    else:
+        cost = np.asarray(pixel_cost, dtype=float)[inside]
+
+    cumcost = np.cumsum(cost)
+    targets = cumcost[-1] * np.arange(1, n_segments) / n_segments
+    splits = w[inside][np.searchsorted(cumcost, targets)]
+
+    if filename is not None:
+        np.savetxt(filename, splits)
+    return splits
+
+
+def box_mean(y, n):
+    # running mean of y over n pixels (centred), from a cumulative sum
+    n = max(int(n), 1)
+    c = np.concatenate([[0.], np.cumsum(y)])
+    lo = np.clip(np.arange(len(y)) - n // 2, 0, len(y))
+    hi = np.clip(lo + n, 0, len(y))
+    return (c[hi] - c[lo]) / (hi - lo)
+
+
+def line_strength(wavelength, flux1, flux2, continuum=2., width=1.):
+    '''
+    Line-strength metric of every pixel of a disentangled spectrum: for both
+    components the distance from their running mean over continuum Å plus
+    their gradient (per Å), averaged over width Å. Low in flat continuum,
+    high in and near lines.
+    '''
+    step = np.median(np.diff(wavelength))
+    metric = np.zeros(len(wavelength))
+    for flux in (flux1, flux2):
+        flux = np.asarray(flux, dtype=float)
+        scale = np.std(flux) or 1.
+        metric += np.abs(flux - box_mean(flux, continuum / step)) / scale
+        metric += np.abs(np.gradient(flux, wavelength)) * step / scale
+    return box_mean(metric, width / step)
+
+
+def line_free_splits(wavelength, flux1, flux2, n_segments=None,
+                     spacing=None, lower=4000, upper=6850, search=0.25,
+                     filename='splits.txt', **metric_options):
+    '''
+    Places split points in the flattest continuum of a disentangled
+    spectrum (see line_strength), e.g. from load_data. Starting from
+    n_segments points of equal cost (equal pixel counts, like
+    balanced_splits), or from equally spaced points spacing Å apart, every
+    point moves to the lowest line strength within search times the
+    distance to its neighbours. The split points are saved to filename like
+    the 'w' key of PointBrowser does, and returned. Raises ValueError when
+    neither n_segments nor spacing is given, or when the spectrum has no
+    pixels between lower and upper.
+    '''
+    if n_segments is None and spacing is None:
+        raise ValueError("give n_segments or spacing")
+    wavelength = np.asarray(wavelength)
+    inside = np.flatnonzero((wavelength >= lower) & (wavelength <= upper))
+    if len(inside) == 0:
+        raise ValueError("no pixels between {} and {} A".format(lower, upper))
+    metric = line_strength(wavelength, flux1, flux2, **metric_options)
+
+    if spacing is not None:
+        # only within the spectrum, which may not cover lower to upper
+        start = max(lower, wavelength[inside[0]])
+        end = min(upper, wavelength[inside[-1]])
+        targets = np.searchsorted(
+            wavelength, np.arange(start + spacing, end, spacing))
+    else:
+        targets = inside[len(inside) * np.arange(1, n_segments) //
+                         n_segments]
+
+    # pixels each point may move, a fraction of the distance to its
+    # neighbours
+    edges = np.concatenate([[inside[0]], targets, [inside[-1]]])
+    reach = (search * np.minimum(np.diff(edges)[:-1],
+                                 np.diff(edges)[1:])).astype(int)
+    splits = []
+    for target, r in zip(targets, reach):
+        lo = max(target - r, inside[0])
+        hi = min(target + r + 1, inside[-1] + 1)
+        # of the (nearly) flattest pixels, the one closest to the target
+        local = metric[lo:hi]
+        flat = np.flatnonzero(local <= 1.05 * local.min() + 1e-12) + lo
+        splits.append(wavelength[flat[np.argmin(np.abs(flat - target))]])
+    splits = np.array(splits)
+
+    if filename is not None:
+        np.savetxt(filename, splits)
+    return splits
+
+
+def select_obs_file(directory='.'):
+    # lets the user choose the .obs master file
+    obslist = glob.glob(directory + '/*.obs')
+    obslist = [i for i in obslist if '_split_' not in i and 'used' not in i]
+    obslist.sort()
+
+    if len(obslist) == 0:
+        print("No .obs file found!")
+        raise SystemExit
+
+    for i in range(len(obslist)):
+        print(str(i) + ' ' + obslist[i])
+
+    chosenfile = input("\n-> ")
+    good = False
+    while not good:
+        try:
+            obsfilename = obslist[int(chosenfile)]
+            good = True
+        except IndexError:
+            print("Invalid value. Try again...")
+            chosenfile = input("\n-> ")
+        except ValueError:
+            print("Value must be a number. Try again...")
+            chosenfile = input("\n-> ")
+
+    return obsfilename
+
+
 def path_chooser():
     '''
     cwd -> current working directory
@@ -242,10 +524,16 @@ def path_chooser():
     return os.getcwd()
 
 
-def setBounds(file, splits, overlap=0.5):  # overlap editable. in Å.
+def setBounds(file, splits, overlap=0.5, slice_obs=True):  # overlap in Å.
     # generates a number of .in files according to the provided splits;
     # labels the split files so that they are in order when .sort() is used
     # over their names.
+    # with slice_obs, every split .in reads its own trimmed copy of the .obs
+    # file, containing only the rows of its wavelength range, instead of
+    # the whole master file.
+    # the outputs of every split are named after the .in file, so splits of
+    # different .in files can share a directory. Returns the names of the
+    # split .in files.
 
     # edit .in file
     # read original file
@@ -255,6 +543,7 @@ def setBounds(file, splits, overlap=0.5):  # overlap editable. in Å.
 
     # read splits
     bounds = np.loadtxt(splits)
+    obsfile = lines[0].split('  ')[0]
     maxval = modline1 = lines[0].split('  ')[2]
 
     try:
@@ -263,6 +552,9 @@ def setBounds(file, splits, overlap=0.5):  # overlap editable. in Å.
         n_splits = 1
 
     digits = len(str(n_splits))
+    ranges = []
+    obsnames = []
+    innames = []
 
     for k in range(n_splits + 1):
 
@@ -289,7 +581,14 @@ def setBounds(file, splits, overlap=0.5):  # overlap editable. in Å.
             modline1[1] = str(np.log(bounds[k - 1] - overlap))  # new min value
             modline1[2] = str(np.log(bounds[k] + overlap))  # new maximum value
 
-        modline1[3] = 'sig_aql_used_{:0{}d}.obs'.format(k + 1, digits)
+        ranges.append((float(modline1[1]), float(modline1[2])))
+        if slice_obs:
+            modline1[0] = file[:-3] + '_split_{:0{}d}.obs'.format(
+                k + 1, digits)
+            obsnames.append(modline1[0])
+
+        # outputs are named after the .in file
+        modline1[3] = '{}_used_{:0{}d}.obs'.format(file[:-3], k + 1, digits)
         firstline = ''
 
         for i in range(len(modline1)):
@@ -301,10 +600,10 @@ def setBounds(file, splits, overlap=0.5):  # overlap editable. in Å.
         # edit last line
 
         modline2 = lines[-2].split('  ')
-        modline2[3] = 'sig_aql_{:0{}d}.mod'.format(k + 1, digits)
-        modline2[4] = 'sig_aql_{:0{}d}.res'.format(k + 1, digits)
-        modline2[5] = 'sig_aql_{:0{}d}.rvs'.format(k + 1, digits)
-        modline2[6] = 'sig_aql_{:0{}d}.log'.format(k + 1, digits)
+        modline2[3] = '{}_{:0{}d}.mod'.format(file[:-3], k + 1, digits)
+        modline2[4] = '{}_{:0{}d}.res'.format(file[:-3], k + 1, digits)
+        modline2[5] = '{}_{:0{}d}.rvs'.format(file[:-3], k + 1, digits)
+        modline2[6] = '{}_{:0{}d}.log'.format(file[:-3], k + 1, digits)
         lastline = ''
         for i in range(len(modline2)):
             if i != 0:
@@ -313,12 +612,63 @@ def setBounds(file, splits, overlap=0.5):  # overlap editable. in Å.
                 lastline = modline2[0]
 
         # write new file
-        newfile = open(file[:-3] + '_split_{:0{}d}.in'.format(k + 1, digits), 'w')
+        innames.append(file[:-3] + '_split_{:0{}d}.in'.format(k + 1, digits))
+        newfile = open(innames[-1], 'w')
         newfile.write(firstline)  # write edited line
         for i in range(1, len(lines) - 2):  # write original lines
             newfile.write(lines[i])
         newfile.write(lastline)  # write edited line
         newfile.write('\n')
+        newfile.close()
+
+    if slice_obs:
+        write_obs_slices(obsfile, ranges, obsnames)
+
+    return innames
+
+
+def write_obs_slices(obsfile, ranges, names):
+    '''
+    Streams once through the master .obs file and writes every row to each
+    slice whose ln(wavelength) range (min, max) contains it. The ranges must
+    be sorted, like the segments made by setBounds.
+    The '# ncols X nrows' header of the master is copied with the row count
+    of the slice, which is filled in once all rows are written.
+    '''
+    outs = [open(name, 'w') for name in names]
+    counts = [0] * len(names)
+
+    with open(obsfile, 'r') as f:
+        first = f.readline()
+        header = first.split() if first.startswith('#') else None
+        if header is not None:
+            # reserve room for the row count, it's rewritten at the end
+            width = max(len(header[-1]), 10)
+            for out in outs:
+                out.write(' '.join(header[:-1] + [' ' * width]) + '\n')
+            rows = f
+        else:
+            rows = itertools.chain([first], f)
+
+        active = 0  # first slice that can still receive rows
+        for line in rows:
+            if not line.strip() or line.startswith('#'):
+                continue
+            x = float(line.split(None, 1)[0])
+            while active < len(ranges) and x > ranges[active][1]:
+                active += 1
+            k = active
+            while k < len(ranges) and ranges[k][0] <= x:
+                if x <= ranges[k][1]:
+                    outs[k].write(line)
+                    counts[k] += 1
+                k += 1
+
+    for out, count in zip(outs, counts):
+        if header is not None:
+            out.seek(0)
+            out.write(' '.join(header[:-1] + [str(count).ljust(width)]))
+        out.close()
 
 
 def select_bounds_file():
@@ -379,22 +729,432 @@ def select_in_file():
     return infilename
 
 
-def fd3(name):
-        os.system('./fd3 < {} > '.format(name) + name[:-3] + '.out')
+def read_in_file(name):
+    # returns the non-blank lines of an .in file, split on whitespace
+    with open(name, 'r') as f:
+        return [line.split() for line in f if line.strip()]
+
+
+def fd3_outputs(name):
+    # files written by fd3 for the given .in file: the used part of the .obs
+    # file and its model (the .obs.mod files that are stitched), the
+    # .mod/.res/.rvs/.log files named on the last line and the captured
+    # stdout
+    lines = read_in_file(name)
+    used = lines[0][3]
+    return [used, used + '.mod'] + lines[-1][3:7] + [name[:-3] + '.out']
+
+
+ORBIT_ELEMENTS = ['period', 't0', 'e', 'omega', 'k1', 'k2', 'domega']
+
+
+def in_layout(lines):
+    '''
+    Indices of the parts of an .in file (a list of lines): the first line,
+    the epoch lines, the orbit line and the last line.
+    '''
+    filled = [i for i in range(len(lines)) if lines[i].strip()]
+    first, orbit, last = filled[0], filled[-2], filled[-1]
+    epochs = [i for i in filled[1:-2] if len(lines[i].split()) == 5]
+    return first, epochs, orbit, last
+
+
+def warm_start(name, logfile, step_scale=0.25, restarts=2, iterations=None):
+    '''
+    Seeds the orbit line of the .in file name with the best fit found in
+    the fd3 .log file logfile, multiplies the simplex steps of the free
+    elements by step_scale and limits the number of restarts to restarts
+    (and of iterations per restart to iterations, when given).
+    The .log lines hold either all orbit elements or only the free ones
+    (the elements with a non-zero step). Returns False when logfile has no
+    usable fit; the .in file is then left alone.
+    '''
+    fit = fd3_progress.best_fit(logfile)
+    if fit is None:
+        return False
+    params = fit[1]
+
+    with open(name, 'r') as f:
+        lines = f.readlines()
+    first, epochs, orbit, last = in_layout(lines)
+
+    orbitline = lines[orbit].split()
+    steps = [float(x) for x in orbitline[1::2]]
+    free = [i for i in range(len(steps)) if steps[i] != 0]
+    if len(params) == len(steps):
+        seeded = range(len(steps))
+    elif len(params) == len(free) and free:
+        seeded = free
+    else:
+        return False
+
+    for i, value in zip(seeded, params):
+        orbitline[2 * i] = repr(value)
+    for i in free:
+        orbitline[2 * i + 1] = repr(steps[i] * step_scale)
+    lines[orbit] = '  '.join(orbitline) + '\n'
+
+    lastline = lines[last].split()
+    lastline[0] = str(min(int(lastline[0]), restarts))
+    if iterations is not None:
+        lastline[1] = str(min(int(lastline[1]), iterations))
+    lines[last] = '  '.join(lastline) + '\n'
+
+    with open(name, 'w') as f:
+        f.writelines(lines)
+    return True
+
+
+def warm_start_segments(filenames, logfile=None, step_scale=0.25,
+                        restarts=2, use_cache=True):
+    '''
+    Warm-starts (see warm_start) every .in file in filenames (in wavelength
+    order) from its own .log file of a previous run, else from the nearest
+    segment that has one, else from logfile. Segments whose results are in
+    the result cache are left alone, so they are still reused.
+    Returns the number of warm-started segments.
+    '''
+    logs = [fd3_outputs(name)[5] for name in filenames]
+    finished = [k for k in range(len(filenames))
+                if fd3_progress.best_fit(logs[k]) is not None]
+
+    n = 0
+    for k, name in enumerate(filenames):
+        if use_cache and fd3_cache.contains(fd3_cache.segment_key(name)):
+            continue
+        if finished:
+            source = logs[min(finished, key=lambda j: abs(j - k))]
+        else:
+            source = logfile
+        if source is not None and warm_start(name, source, step_scale,
+                                             restarts):
+            n += 1
+    print("{} of {} segments warm-started".format(n, len(filenames)))
+    return n
+
+
+def estimate_cost(name):
+    # fd3 run time scales with the number of pixels, which on the
+    # ln(wavelength) grid is proportional to the width of the ln range
+    first = read_in_file(name)[0]
+    return float(first[2]) - float(first[1])
+
+
+SCRATCH_DIR = os.environ.get('FD3_SCRATCH_DIR')  # None: system temp dir
+
+
+def render_job(name, scratch):
+    '''
+    Text of the .in file name for a run inside the directory scratch: the
+    .obs file is linked into scratch and all outputs are written there
+    under their own names. Returns the text and the (scratch path,
+    destination) of every output of fd3_outputs except the .out file.
+    '''
+    with open(name, 'r') as f:
+        lines = f.readlines()
+    first, epochs, orbit, last = in_layout(lines)
+
+    firstline = lines[first].split()
+    obs = os.path.basename(firstline[0])
+    os.symlink(os.path.abspath(firstline[0]), os.path.join(scratch, obs))
+    firstline[0] = obs
+    firstline[3] = os.path.basename(firstline[3])
+    lines[first] = '  '.join(firstline) + '\n'
+
+    lastline = lines[last].split()
+    lastline[3:7] = [os.path.basename(output) for output in lastline[3:7]]
+    lines[last] = '  '.join(lastline) + '\n'
+
+    moves = [(os.path.join(scratch, os.path.basename(output)), output)
+             for output in fd3_outputs(name)[:6]]
+    return ''.join(lines), moves
+
+
+def move_output(source, target):
+    # moves source to target atomically, also from another filesystem
+    try:
+        os.replace(source, target)
+    except OSError:
+        tmp = '{}.{}.tmp'.format(target, os.getpid())
+        shutil.copyfile(source, tmp)
+        os.replace(tmp, target)
+
+
+# settings of the short run that finishes a job stopped on a plateau
+FINISH_STEP_SCALE = 0.25
+FINISH_RESTARTS = 1
+FINISH_ITERATIONS = None  # None: as on the .in file
 
 
-def run_fd3(filenames):
-    # runs all files supplied by filenames through fd3, in order
+def finish_job(name, sources, directory):
+    '''
+    Writes a copy of the .in file name to directory, warm-started (see
+    warm_start) from the best fit in the files sources (the .log file and
+    stdout of a stopped run), to finish a job that was stopped on a
+    plateau. Returns the path of the copy, or None when no fit was found.
+    '''
+    fits = [(fd3_progress.best_fit(source), source) for source in sources]
+    fits = [(fit[0], source) for fit, source in fits if fit is not None]
+    copy = os.path.join(directory, os.path.basename(name))
+    shutil.copyfile(name, copy)
+    for chi2, source in sorted(fits):
+        if warm_start(copy, source, FINISH_STEP_SCALE, FINISH_RESTARTS,
+                      FINISH_ITERATIONS):
+            return copy
+    os.remove(copy)
+    return None
+
+
+def fd3(name, timeout=None, retries=0, convergence=None, scratch_dir=None):
+    '''
+    Runs fd3 on one .in file, killing it after timeout seconds and trying
+    again up to retries times when it fails. Returns the status of the job:
+    a dict with the name, exit code (None when killed), number of attempts,
+    run time of the last attempt and the output files, and for fd3_trace the
+    start and end time, worker pid and the CPU time and peak memory of fd3.
+    stdout and the .log file are followed while fd3 runs (see
+    fd3_progress.py); convergence holds the settings of a
+    ConvergenceMonitor that stops the job early when chi2 has plateaued or
+    diverges, the reason is then in status['stopped']. fd3 leaves no
+    outputs when it is stopped, so a plateaued job is finished by a short
+    unmonitored run warm-started from its best fit so far (see finish_job;
+    a full run when there is none), which doesn't count as a retry.
+    Every attempt runs in its own scratch directory below scratch_dir
+    (default SCRATCH_DIR, or the system temp directory; /dev/shm keeps it in
+    memory) with the .in text piped to fd3, and only the outputs of the
+    last attempt are moved next to the .in file.
+    '''
+    if scratch_dir is None:
+        scratch_dir = SCRATCH_DIR
+    status = {'name': name, 'returncode': None, 'attempts': 0,
+              'runtime': 0., 'timed_out': False, 'stopped': None,
+              'outputs': fd3_outputs(name),
+              'worker': os.getpid(), 'started': time.time()}
+    cpu = fd3_trace.child_usage()[0]
+    binary = os.path.abspath('fd3')
+
+    source = name  # .in file of the next attempt
+    finishing = None  # directory with the warm-started copy of the .in file
+    failures = 0
+    while True:
+        status['attempts'] += 1
+        if finishing is None:
+            tic = time.time()
+        scratch = tempfile.mkdtemp(prefix='fd3-', dir=scratch_dir)
+        try:
+            text, moves = render_job(source, scratch)
+            with open(name[:-3] + '.out', 'w') as stdout:
+                proc = subprocess.Popen([binary], cwd=scratch,
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT,
+                                        universal_newlines=True, bufsize=1)
+
+                terminated = []
+
+                def stop(reason):
+                    if proc.poll() is None:
+                        terminated.append(reason)
+                        proc.terminate()
+
+                monitor = None
+                if convergence is not None and status['stopped'] is None:
+                    monitor = fd3_progress.ConvergenceMonitor(**convergence)
+                tracker = fd3_progress.ProgressTracker(name, monitor, stop)
+
+                # follow the .log file in a thread, and stdout in another
+                # one so the timeout below still works
+                done = threading.Event()
+                followers = [
+                    threading.Thread(target=fd3_progress.follow_file,
+                                     args=(moves[5][0], tracker.feed,
+                                           done)),
+                    threading.Thread(target=copy_lines,
+                                     args=(proc.stdout, stdout,
+                                           tracker.feed))]
+                for follower in followers:
+                    follower.start()
+
+                try:
+                    proc.stdin.write(text)
+                    proc.stdin.close()
+                except OSError:
+                    pass  # fd3 exited without reading its input
+
+                try:
+                    status['returncode'] = proc.wait(timeout=timeout)
+                    status['timed_out'] = False
+                except subprocess.TimeoutExpired:
+                    proc.kill()
+                    proc.wait()
+                    status['returncode'] = None
+                    status['timed_out'] = True
+                done.set()
+                for follower in followers:
+                    follower.join()
+            status['runtime'] = time.time() - tic
+            if terminated:
+                status['stopped'] = terminated[0]
+                status['returncode'] = None
+
+            if status['timed_out']:
+                tracker.write(force=True, state='timed out')
+            elif not terminated:
+                tracker.write(force=True, state='finished' if
+                              status['returncode'] == 0 else 'failed')
+
+            if terminated and terminated[0] == 'plateau':
+                # converged: finish with a short run from the best fit
+                finishing = tempfile.mkdtemp(prefix='fd3-finish-',
+                                             dir=scratch_dir)
+                source = finish_job(name, [moves[5][0], name[:-3] + '.out'],
+                                    finishing) or name
+                final = False
+            else:
+                if status['returncode'] != 0 and not terminated:
+                    failures += 1
+                final = status['returncode'] == 0 or terminated or \
+                    failures > retries
+            if final:
+                for output, target in moves:
+                    if os.path.exists(output):
+                        move_output(output, target)
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+        if final:
+            break
+
+    if finishing is not None:
+        shutil.rmtree(finishing, ignore_errors=True)
+    status['finished'] = time.time()
+    usage = fd3_trace.child_usage()
+    status['cpu'] = usage[0] - cpu
+    status['peak_rss'] = usage[1]  # largest fd3 run on this worker so far
+    status['ok'] = status['returncode'] == 0
+    return status
+
+
+def copy_lines(source, target, callback):
+    # copies the output of fd3 to the .out file, line by line
+    for line in source:
+        target.write(line)
+        callback(line)
+    source.close()
+
+
+def index_run(in_file, splits_file, filenames, obs_is_slice=True):
+    '''
+    Records a run of the .in files filenames, split from in_file with
+    splits_file, in the run index (see fd3_index.py), with the ranges,
+    hashes and files of all segments. With obs_is_slice, the .obs files
+    they read are slices that clean() may remove. Returns the run id, to be
+    passed to run_fd3.
+    '''
+    db = fd3_index.connect()
+    run_id = fd3_index.start_run(db, in_file, splits_file)
+    for name in filenames:
+        first = read_in_file(name)[0]
+        files = dict(zip(fd3_cache.OUTPUT_ROLES, fd3_outputs(name)))
+        files['in'] = name
+        files['progress'] = name[:-3] + '.progress'
+        if obs_is_slice:
+            files['obs'] = first[0]
+        fd3_index.add_segment(db, run_id, name, float(first[1]),
+                              float(first[2]), fd3_cache.segment_key(name),
+                              files)
+    db.close()
+    return run_id
+
+
+def run_fd3(filenames, timeout=None, retries=1, processes=None,
+            use_cache=True, queue_dir=None, convergence=None,
+            scratch_dir=None, run_id=None):
+    '''
+    Runs all files supplied by filenames through fd3 in a process pool.
+    The largest segments are started first and results are collected as
+    they come in, so one slow segment doesn't hold up the others. Jobs are
+    killed after timeout seconds and retried up to retries times.
+    With use_cache, segments that were run before with the same input are
+    copied from the result cache (see fd3_cache.py) instead.
+    With queue_dir, the jobs are put in a shared-filesystem work queue
+    instead (see fd3_queue.py), to be run by workers on any host; processes
+    is then the number of workers started on this machine.
+    convergence enables early stopping of jobs (see fd3 and fd3_progress);
+    fd3_progress.print_progress shows the live progress of every segment.
+    scratch_dir is where the jobs run (see fd3); queue workers use
+    SCRATCH_DIR ($FD3_SCRATCH_DIR) of their own host.
+    With run_id (see index_run), segments whose unchanged outputs are in
+    the run index are not run again, and the status of every job is
+    recorded there.
+    Returns the status of every job (see fd3), sorted by filename.
+    '''
 
     if len(glob.glob("fd3")) == 0:
         print("\n### fd3 not found! ###")
-        return
+        return []
 
     print("\nFound {} .in files...\n".format(len(filenames)))
 
-    pool = mp.Pool()
+    statuses = []
+    keys = {}
+    jobs = []
+    db = None
+    if run_id is not None:
+        db = fd3_index.connect()
+    for name in filenames:
+        if use_cache or db is not None:
+            keys[name] = fd3_cache.segment_key(name)
+        if db is not None:
+            # the .in file may have changed since index_run (warm start)
+            fd3_index.update_hash(db, run_id, name, keys[name])
+            outputs = fd3_outputs(name)
+            found = fd3_index.find_outputs(db, keys[name],
+                                           fd3_cache.OUTPUT_ROLES[:6])
+            if found is not None:
+                # finished before: reuse the outputs, in place if possible
+                for source, target in zip(found, outputs):
+                    if os.path.abspath(target) != source:
+                        shutil.copyfile(source, target)
+                statuses.append({'name': name, 'returncode': 0,
+                                 'attempts': 0, 'runtime': 0.,
+                                 'timed_out': False, 'ok': True,
+                                 'cached': True, 'resumed': True,
+                                 'outputs': outputs})
+                continue
+        if use_cache:
+            if fd3_cache.fetch(keys[name], fd3_outputs(name)):
+                statuses.append({'name': name, 'returncode': 0,
+                                 'attempts': 0, 'runtime': 0.,
+                                 'timed_out': False, 'ok': True,
+                                 'cached': True,
+                                 'outputs': fd3_outputs(name)})
+                continue
+        jobs.append(name)
+
+    if use_cache or db is not None:
+        resumed = sum(1 for status in statuses if status.get('resumed'))
+        if resumed:
+            print("Run index: {} finished segments reused".format(resumed))
+        print("Result cache: {} hits, {} misses\n".format(
+            len(statuses) - resumed, len(jobs)))
+    if db is not None:
+        for status in statuses:
+            fd3_index.record_status(db, run_id, status)
+
+    jobs.sort(key=estimate_cost, reverse=True)
+
+    submitted = time.time()  # before any job is handed out
+    if queue_dir is None:
+        pool = mp.Pool(processes)
+        results = pool.imap_unordered(
+            functools.partial(fd3, timeout=timeout, retries=retries,
+                              convergence=convergence,
+                              scratch_dir=scratch_dir), jobs)
+    else:
+        pool = None
+        results = fd3_queue.run_jobs(queue_dir, jobs, timeout, retries,
+                                     processes or 0, convergence)
 
-    # tic = time.time()
     bar = progressbar.ProgressBar(
         maxval=len(filenames),
         widgets=[
@@ -402,20 +1162,70 @@ def run_fd3(filenames):
             progressbar.Percentage(), ' ',
             progressbar.ETA()])
     bar.start()
-    for i, _ in enumerate(pool.imap(fd3, filenames), 1):
-        bar.update(i)
+    bar.update(len(statuses))
+    for status in results:
+        status['cached'] = False
+        status.setdefault('submitted', submitted)
+        fd3_trace.TRACER.add_job(status)
+        if use_cache and status['ok']:
+            fd3_cache.store(keys[status['name']], status['outputs'])
+        if db is not None:
+            fd3_index.record_status(db, run_id, status)
+        statuses.append(status)
+        bar.update(len(statuses))
     bar.finish()
+    if pool is not None:
+        pool.close()
+        pool.join()
+    if db is not None:
+        db.close()
+
+    statuses.sort(key=lambda status: status['name'])
+    failed = [status for status in statuses if not status['ok']]
     print("\nProcessed {0} files.".format(len(filenames)))
+    stopped = [status for status in statuses if status.get('stopped')]
+    if stopped:
+        print("Stopped early: {} converged, {} diverging".format(
+            sum(status['stopped'] == 'plateau' for status in stopped),
+            sum(status['stopped'] == 'diverging' for status in stopped)))
+    for status in failed:
+        if status['timed_out']:
+            reason = 'timed out'
+        elif status.get('stopped'):
+            reason = status['stopped']
+        else:
+            reason = 'exit code {}'.format(status['returncode'])
+        print("### fd3 failed on {} ({}, {} attempts) ###".format(
+            status['name'], reason, status['attempts']))
+
+    return statuses
 
 
-def average_overlap(filenames):
+def count_rows(filename):
+    # counts the data rows of a text file without parsing any numbers, so the
+    # size of the stitched spectrum is known before any segment is loaded.
+    # blank lines and comments are skipped, like np.loadtxt does.
+    n = 0
+    with open(filename, 'rb') as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith(b'#'):
+                n += 1
+    return n
+
+
+def average_overlap(filenames, base='Sig_Aql'):
     # generates complete spectra with averaged overlaps
     # it is essential that the files are sorted by ascending wavelength
-    # every loop uses the k'th index, starting at 1 in stead of 0
-
-    w = np.array([])
-    s1 = np.array([])
-    s2 = np.array([])
+    # the output arrays are allocated once, sized from the row counts of all
+    # segments (an upper bound, as overlaps are only counted once), and every
+    # segment is written in place after blending its overlap with the tail
+    # of the previous one. Only one segment is in memory next to the output.
+
+    n_total = sum(count_rows(name) for name in filenames)
+    w = np.empty(n_total)
+    s1 = np.empty(n_total)
+    s2 = np.empty(n_total)
     # print('\nReading light factors from .in file...')
     # infiles = glob.glob('*.in')
     # infiles.sort()
@@ -432,69 +1242,188 @@ def average_overlap(filenames):
             progressbar.Percentage(), ' ',
             progressbar.ETA()])
     bar.start()
-    # read the needed files
-    file1 = np.loadtxt(filenames[0]).transpose()
-    w1 = file1[0]
-    s11 = file1[1] + (1 - np.mean(file1[1][0:20]))  # * lf1)
-    s21 = file1[2] + (1 - np.mean(file1[2][0:20]))  # * lf2)
-    for k in range(1, len(filenames)):
-        file2 = np.loadtxt(filenames[k]).transpose()
+
+    prev = 0  # start of the previous (trimmed) segment in the output
+    pos = 0  # end of the filled part of the output
+    for k in range(len(filenames)):
+        with fd3_trace.stage('loading', file=filenames[k]):
+            file2 = load_table(filenames[k]).transpose()
         w2 = file2[0]
-        s12 = file2[1] + (1 - np.mean(file2[1][0:20]))
-        s22 = file2[2] + (1 - np.mean(file2[2][0:20]))
-
-        # determine how many elements overlap
-        n_overlap = len(np.intersect1d(w1, w2))
-        w2 = w2[n_overlap:]
-
-        # calculate averages over overlapping indices
-        weights = np.array([np.arange(1, n_overlap + 1)[::-1],
-                            np.arange(1, n_overlap + 1)])
-        data = np.array([s11[-(n_overlap):], s12[:n_overlap]])
-        newdata = np.average(data, axis=0, weights=weights)
-        data2 = np.array([s21[-(n_overlap):], s22[:n_overlap]])
-        newdata2 = np.average(data2, axis=0, weights=weights)
-
-        # splicing in averaged overlap
-        s11[-(n_overlap):] = newdata
-        s12 = s12[n_overlap:]
-        s21[-(n_overlap):] = newdata2
-        s22 = s22[n_overlap:]
-
-        w = np.append(w, w1)
-        s1 = np.append(s1, s11)
-        s2 = np.append(s2, s21)
-
-        w1 = w2
-        s11 = s12
-        s21 = s22
+        s12, s22 = fd3_norm.shift_window(file2[1:3], fd3_norm.EDGE)
+
+        # determine how many elements overlap with the previous segment
+        n_overlap = len(np.intersect1d(w[prev:pos], w2))
+
+        if n_overlap > 0:
+            # calculate averages over overlapping indices and splice them
+            # into the tail of the previous segment
+            weights = np.array([np.arange(1, n_overlap + 1)[::-1],
+                                np.arange(1, n_overlap + 1)])
+            tail = slice(pos - n_overlap, pos)
+            data = np.array([s1[tail], s12[:n_overlap]])
+            s1[tail] = np.average(data, axis=0, weights=weights)
+            data2 = np.array([s2[tail], s22[:n_overlap]])
+            s2[tail] = np.average(data2, axis=0, weights=weights)
+
+        # write the rest of the segment behind it
+        n_new = len(w2) - n_overlap
+        w[pos:pos + n_new] = w2[n_overlap:]
+        s1[pos:pos + n_new] = s12[n_overlap:]
+        s2[pos:pos + n_new] = s22[n_overlap:]
+        prev = pos
+        pos += n_new
 
         bar.update(k + 1)
 
-    w = np.append(w, w1)
-    s1 = np.append(s1, s11)
-    s2 = np.append(s2, s21)
-
     bar.finish()
 
-    np.savetxt('Sig_Aql_A_stitched.txt', np.array([np.exp(w), s1]).transpose())
-    np.savetxt('Sig_Aql_B_stitched.txt', np.array([np.exp(w), s2]).transpose())
+    write_stitched(w[:pos], s1[:pos], s2[:pos], base)
 
 
-def clean():
-    n = 0
-    filenames = glob.glob('*used_[0-9]*')
+def segment_bounds(filenames):
+    # ln(wavelength) range of every segment
+    bounds = []
     for name in filenames:
-        os.remove(name)
-    n += len(filenames)
-    filenames = glob.glob('*[0-9].in')
+        w = load_table(name)[:, 0]
+        bounds.append((w[0], w[-1]))
+    return np.array(bounds)
+
+
+def write_stitched(w, s1, s2, base='Sig_Aql'):
+    # w is in ln(wavelength), the files are written in Å, as
+    # <base>_A_stitched.txt and <base>_B_stitched.txt
+    np.savetxt(base + '_A_stitched.txt', np.array([np.exp(w), s1]).transpose())
+    np.savetxt(base + '_B_stitched.txt', np.array([np.exp(w), s2]).transpose())
+
+
+def noise_sigma(flux):
+    # robust estimate of the pixel noise of a spectrum from the median
+    # absolute deviation of its first differences
+    sigma = 1.4826 * np.median(np.abs(np.diff(flux))) / np.sqrt(2)
+    if sigma > 0:
+        return sigma
+    return 1.
+
+
+def linear_kernel(t, flux):
+    return t
+
+
+def cosine_kernel(t, flux):
+    return np.sin(0.5 * np.pi * t)**2
+
+
+def snr_kernel(t, flux):
+    # linear taper, weighted by the inverse variance of the segment
+    return t / noise_sigma(flux)**2
+
+
+# weight kernels for overlap_add. A kernel gets the taper position t, which
+# runs from 0 to 1 over the overlap towards the inside of the segment and is
+# 1 elsewhere, and the flux of one component of the segment.
+STITCH_KERNELS = {
+    'linear': linear_kernel,
+    'cosine': cosine_kernel,
+    'snr': snr_kernel,
+}
+
+
+def global_grid(wavelengths, tol):
+    # merges the ln(wavelength) grids of all segments into one sorted grid;
+    # values closer than tol to the previous one are taken to be the same
+    # pixel
+    w = np.sort(np.concatenate(wavelengths))
+    keep = np.ones(len(w), dtype=bool)
+    keep[1:] = np.diff(w) > tol
+    return w[keep]
+
+
+def taper(n, lead, trail):
+    # position within the overlap for every pixel of a segment of n pixels
+    # that overlaps its neighbours by lead pixels at the start and trail
+    # pixels at the end
+    i = np.arange(n)
+    t = np.ones(n)
+    if lead > 0:
+        t = np.minimum(t, (i + 1) / (lead + 1))
+    if trail > 0:
+        t = np.minimum(t, (n - i) / (trail + 1))
+    return t
+
+
+def overlap_add(filenames, kernel='linear', tol=None):
+    '''
+    Stitches all segments in one pass on a shared ln(wavelength) grid.
+    Every segment is mapped onto the global grid with np.searchsorted, its
+    weighted flux and its weights are added to two accumulators and the
+    spectrum is divided out once at the end. Any number of segments may
+    overlap the same pixel, and grids only have to agree within tol (default:
+    a quarter of the median pixel step).
+
+    kernel is one of STITCH_KERNELS or a function kernel(t, flux).
+    Returns the ln(wavelength) grid and both stitched components.
+    '''
+    if not callable(kernel):
+        kernel = STITCH_KERNELS[kernel]
+
+    segments = []
     for name in filenames:
-        os.remove(name)
-    n += len(filenames)
-    filenames = glob.glob('*[0-9].out')
+        with fd3_trace.stage('loading', file=name):
+            mod = load_table(name).transpose()
+        s1, s2 = fd3_norm.shift_window(mod[1:3], fd3_norm.EDGE)
+        segments.append((mod[0], s1, s2))
+
+    if tol is None:
+        tol = 0.25 * np.median(np.diff(segments[0][0]))
+
+    grid = global_grid([seg[0] for seg in segments], tol)
+
+    # map every segment onto the grid
+    indices = []
+    for w, _, _ in segments:
+        idx = np.searchsorted(grid, w - tol)
+        if np.any(np.abs(grid[np.minimum(idx, len(grid) - 1)] - w) > tol):
+            raise ValueError("segment doesn't fit the global grid, "
+                             "try a larger tolerance")
+        indices.append(idx)
+
+    starts = np.array([idx[0] for idx in indices])
+    ends = np.array([idx[-1] + 1 for idx in indices])
+
+    num = np.zeros((2, len(grid)))
+    den = np.zeros((2, len(grid)))
+    for k, (w, s1, s2) in enumerate(segments):
+        # overlap with segments that start before / end after this one
+        others = np.arange(len(segments)) != k
+        before = others & (starts < starts[k])
+        after = others & (ends > ends[k])
+        lead = min(len(w), max(ends[before].max(initial=0) - starts[k], 0))
+        trail = min(len(w), max(ends[k] - starts[after].min(initial=ends[k]), 0))
+        t = taper(len(w), lead, trail)
+
+        for c, flux in enumerate((s1, s2)):
+            weight = kernel(t, flux)
+            num[c, indices[k]] += weight * flux
+            den[c, indices[k]] += weight
+
+    stitched = num / den
+    return grid, stitched[0], stitched[1]
+
+
+def clean(directory='.'):
+    # removes the intermediate files (split .in and .obs files, used .obs
+    # files and their models, .progress and .out files) of the runs in
+    # directory that are recorded in the run index
+    db = fd3_index.connect()
+    filenames = fd3_index.intermediate_files(db, directory)
+    db.close()
+    n = 0
     for name in filenames:
-        os.remove(name)
-    n += len(filenames)
+        try:
+            os.remove(name)
+            n += 1
+        except OSError:
+            pass
     print("{} files cleaned up!".format(n))
 
 
@@ -520,14 +1449,41 @@ def main():
 
     print("\n### Select model .in file ###\n")
 
-    infilename = select_in_file()
-
-    print('\n### Select bounds file ###\n')
+    with fd3_trace.stage('file selection'):
+        infilename = select_in_file()
+
+    overlap = 0.5
+    tuned = None
+    tunechoice = input("\nAutotune the number of segments and overlap? "
+                       "(Y/N): ")
+    while tunechoice not in ('Y', 'y', 'N', 'n'):
+        tunechoice = input("\nAutotune the number of segments and overlap? "
+                           "(Y/N): ")
+    if tunechoice == 'Y' or tunechoice == 'y':
+        # fd3_tune imports this module
+        import fd3_tune
+        cores = input("Number of cores (leave empty for all): ").strip()
+        with fd3_trace.stage('autotune'):
+            try:
+                tuned = fd3_tune.autotune(infilename,
+                                          int(cores) if cores else None)
+            except ValueError as error:
+                print("\n### Autotuning failed: {} ###".format(error))
+    if tuned is not None:
+        boundsfilename = 'splits.txt'
+        overlap = tuned['overlap']
+    else:
+        print('\n### Select bounds file ###\n')
 
-    boundsfilename = select_bounds_file()
+        with fd3_trace.stage('file selection'):
+            boundsfilename = select_bounds_file()
 
     print("writing files...")
-    setBounds(infilename, boundsfilename)
+    with fd3_trace.stage('setBounds'):
+        filenames = setBounds(infilename, boundsfilename, overlap)
+    # recorded right away, so clean() finds the split files also when fd3
+    # isn't run
+    run_id = index_run(infilename, boundsfilename, filenames)
     print("Done")
 
     runchoice = input("\nRun fd3 "
@@ -538,26 +1494,99 @@ def main():
                           "using the generated .in files? (Y/N): ")
 
     if runchoice == 'Y' or runchoice == 'y':
-        filenames = glob.glob("*[0-9].in")
-        filenames.sort()
-        run_fd3(filenames)
+        queuechoice = input("\nRun on a shared work queue? (Y/N): ")
+        while queuechoice not in ('Y', 'y', 'N', 'n'):
+            queuechoice = input("\nRun on a shared work queue? (Y/N): ")
+        queue_dir = None
+        processes = None
+        if queuechoice == 'Y' or queuechoice == 'y':
+            queue_dir = os.path.abspath(input("\nQueue directory: "))
+            processes = int(input("Number of local workers: "))
+            print("Start more workers with: python fd3_queue.py worker " +
+                  queue_dir)
+
+        warmchoice = input("\nWarm-start segments from previous "
+                           "solutions? (Y/N): ")
+        while warmchoice not in ('Y', 'y', 'N', 'n'):
+            warmchoice = input("\nWarm-start segments from previous "
+                               "solutions? (Y/N): ")
+        if warmchoice == 'Y' or warmchoice == 'y':
+            logfile = input("\n.log file to start from when no segment has "
+                            "one (leave empty for none): ").strip()
+            warm_start_segments(filenames, logfile or None)
+
+        with fd3_trace.stage('run_fd3'):
+            statuses = run_fd3(filenames, processes=processes,
+                               queue_dir=queue_dir, run_id=run_id)
+        if not all(status['ok'] for status in statuses):
+            print("\n### Some segments failed, the stitched spectrum "
+                  "will have gaps ###")
 
         print("\nStitching spectra...\n")
-        modnames = glob.glob('*[0-9].obs.mod')
-        modnames.sort()  # IMPORTANT
-        average_overlap(modnames)
+        modnames = [fd3_outputs(name)[1] for name in filenames
+                    if os.path.exists(fd3_outputs(name)[1])]
+        with fd3_trace.stage('stitching'):
+            stitched = overlap_add(modnames)
+        # named after the .in file, like all outputs of the run
+        stitchedname = infilename[:-3] + '_stitched.npz'
+        with fd3_trace.stage('writing'):
+            save_stitched(stitchedname, *stitched,
+                          boundaries=segment_bounds(modnames),
+                          metadata={'in_file': infilename,
+                                    'splits_file': boundsfilename,
+                                    'segments': modnames,
+                                    'kernel': 'linear',
+                                    'run_id': run_id,
+                                    'created': time.strftime(
+                                        '%Y-%m-%d %H:%M:%S')})
+        print("Saved '{}'".format(stitchedname))
+        db = fd3_index.connect()
+        fd3_index.finish_run(db, run_id, stitchedname,
+                             'finished' if all(status['ok'] for status in
+                                               statuses) else 'gaps')
+        db.close()
+
+        # fd3_results imports this module
+        import fd3_results
+        storename = infilename[:-3] + RESULTS_SUFFIX
+        with fd3_trace.stage('results store'):
+            fd3_results.ingest(filenames, storename,
+                               metadata={'in_file': infilename,
+                                         'splits_file': boundsfilename})
+        print("Segment outputs (.res/.rvs/.log) stored in '{}'".format(
+            storename))
+
+        textchoice = input("\nAlso write the stitched spectra "
+                           "as text? (Y/N): ")
+        while textchoice not in ('Y', 'y', 'N', 'n'):
+            textchoice = input("\nAlso write the stitched spectra "
+                               "as text? (Y/N): ")
+        if textchoice == 'Y' or textchoice == 'y':
+            with fd3_trace.stage('writing text'):
+                write_stitched(*stitched, base=infilename[:-3])
         print("Done!")
+    else:
+        db = fd3_index.connect()
+        fd3_index.finish_run(db, run_id, state='not run')
+        db.close()
 
     cleanchoice = input('\nCleanup? (Y/N): ')
     while cleanchoice not in ('Y', 'y', 'N', 'n'):
         cleanchoice = input("\nCleanup? (Y/N): ")
 
     if cleanchoice == 'Y' or cleanchoice == 'y':
-        clean()
+        with fd3_trace.stage('clean'):
+            clean()
+
+    fd3_trace.TRACER.write_summary('fd3_run_summary.json')
+    fd3_trace.TRACER.write_chrome_trace('fd3_run_trace.json')
+    print("\nTimings written to 'fd3_run_summary.json' and "
+          "'fd3_run_trace.json'")
 
 
-print("""
-### fd3-helper v1.2 ###
+if __name__ == '__main__':
+    print("""
+### fd3-helper v1.3 ###
 """)
 
-main()
+    main()
@@ -0,0 +1,222 @@
+import os
+import sqlite3
+import time
+from fd3_loader import CACHE_DIR
+'''
+v1.0
+18/10/2026
+Persistent index of fd3 runs in an SQLite database. Every run (one pass of
+fd3_helper over the splits of an .in file) and every segment in it is
+recorded with its ln(wavelength) range, the hash of its effective .in file
+(the key of fd3_cache), the fd3 run time, exit status, and the location,
+size and mtime of every file it wrote. With this
+
+  - finished segments of an interrupted or repeated run are found by their
+    hash, and reused when their outputs are still unchanged (find_outputs);
+  - clean() removes exactly the intermediate files of the runs in a
+    directory instead of everything matching a glob (intermediate_files);
+  - the configuration behind every stitched spectrum stays on record.
+
+All paths are absolute. The database is INDEX_PATH ($FD3_INDEX, by default
+index.sqlite in the fd3_loader cache directory).
+'''
+
+INDEX_PATH = os.environ.get('FD3_INDEX',
+                            os.path.join(CACHE_DIR, 'index.sqlite'))
+
+# files written by setBounds and fd3 that clean() may remove
+INTERMEDIATE_ROLES = ('in', 'obs', 'used.obs', 'used.obs.mod', 'progress',
+                      'out')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    directory TEXT,
+    in_file TEXT,
+    splits_file TEXT,
+    stitched TEXT,
+    started REAL,
+    finished REAL,
+    state TEXT
+);
+CREATE TABLE IF NOT EXISTS segments (
+    id INTEGER PRIMARY KEY,
+    run_id INTEGER REFERENCES runs(id),
+    name TEXT,
+    lnmin REAL,
+    lnmax REAL,
+    in_hash TEXT,
+    state TEXT,
+    returncode INTEGER,
+    attempts INTEGER,
+    runtime REAL,
+    cpu REAL,
+    stopped TEXT,
+    finished REAL
+);
+CREATE TABLE IF NOT EXISTS files (
+    segment_id INTEGER REFERENCES segments(id),
+    role TEXT,
+    path TEXT,
+    size INTEGER,
+    mtime_ns INTEGER
+);
+CREATE INDEX IF NOT EXISTS segments_run ON segments(run_id);
+CREATE INDEX IF NOT EXISTS segments_hash ON segments(in_hash, state);
+CREATE INDEX IF NOT EXISTS segments_name ON segments(name);
+CREATE INDEX IF NOT EXISTS files_segment ON files(segment_id);
+CREATE INDEX IF NOT EXISTS files_path ON files(path);
+'''
+
+
+def connect(path=None):
+    # opens the index, creating it when needed
+    if path is None:
+        path = INDEX_PATH
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    db = sqlite3.connect(path, timeout=30)
+    db.execute('PRAGMA journal_mode=WAL')
+    db.executescript(SCHEMA)
+    return db
+
+
+def file_state(path):
+    # (size, mtime_ns) of a file, or (None, None) when it doesn't exist
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None, None
+    return st.st_size, st.st_mtime_ns
+
+
+def start_run(db, in_file, splits_file=None, directory='.'):
+    # records a new run, returns its id
+    with db:
+        cursor = db.execute(
+            'INSERT INTO runs (directory, in_file, splits_file, started, '
+            'state) VALUES (?, ?, ?, ?, ?)',
+            (os.path.abspath(directory),
+             in_file and os.path.abspath(in_file),
+             splits_file and os.path.abspath(splits_file), time.time(),
+             'running'))
+    return cursor.lastrowid
+
+
+def finish_run(db, run_id, stitched=None, state='finished'):
+    with db:
+        db.execute('UPDATE runs SET stitched = ?, finished = ?, state = ? '
+                   'WHERE id = ?',
+                   (stitched and os.path.abspath(stitched), time.time(),
+                    state, run_id))
+
+
+def add_segment(db, run_id, name, lnmin, lnmax, in_hash, files):
+    '''
+    Records a segment of a run, before it is run. files maps the roles of
+    its files (see INTERMEDIATE_ROLES and fd3_cache.OUTPUT_ROLES) to their
+    paths. Returns the id of the segment.
+    '''
+    with db:
+        cursor = db.execute(
+            'INSERT INTO segments (run_id, name, lnmin, lnmax, in_hash, '
+            'state) VALUES (?, ?, ?, ?, ?, ?)',
+            (run_id, os.path.abspath(name), lnmin, lnmax, in_hash,
+             'pending'))
+        segment_id = cursor.lastrowid
+        db.executemany(
+            'INSERT INTO files (segment_id, role, path) VALUES (?, ?, ?)',
+            [(segment_id, role, os.path.abspath(path))
+             for role, path in files.items()])
+    return segment_id
+
+
+def update_hash(db, run_id, name, in_hash):
+    # the hash of a segment whose .in file changed after add_segment
+    with db:
+        db.execute('UPDATE segments SET in_hash = ? WHERE run_id = ? AND '
+                   'name = ?', (in_hash, run_id, os.path.abspath(name)))
+
+
+def record_status(db, run_id, status):
+    '''
+    Stores the status of a finished job (see fd3_helper.fd3) with its
+    segment in run run_id, and the size and mtime of its files.
+    '''
+    if status.get('resumed'):
+        state = 'resumed'
+    elif status.get('cached'):
+        state = 'cached'
+    else:
+        state = 'ok' if status['ok'] else 'failed'
+    with db:
+        row = db.execute(
+            'SELECT id FROM segments WHERE run_id = ? AND name = ?',
+            (run_id, os.path.abspath(status['name']))).fetchone()
+        if row is None:
+            return
+        db.execute(
+            'UPDATE segments SET state = ?, returncode = ?, attempts = ?, '
+            'runtime = ?, cpu = ?, stopped = ?, finished = ? WHERE id = ?',
+            (state, status.get('returncode'), status.get('attempts'),
+             status.get('runtime'), status.get('cpu'), status.get('stopped'),
+             status.get('finished', time.time()), row[0]))
+        files = db.execute('SELECT rowid, path FROM files '
+                           'WHERE segment_id = ?', (row[0],)).fetchall()
+        db.executemany('UPDATE files SET size = ?, mtime_ns = ? '
+                       'WHERE rowid = ?',
+                       [file_state(path) + (rowid,)
+                        for rowid, path in files])
+
+
+def find_outputs(db, in_hash, roles):
+    '''
+    Paths of the outputs (in the order of roles) of the latest successful
+    run of a segment with hash in_hash whose outputs are all unchanged
+    since, or None.
+    '''
+    rows = db.execute(
+        "SELECT id FROM segments WHERE in_hash = ? AND state IN "
+        "('ok', 'cached', 'resumed') ORDER BY finished DESC LIMIT 10",
+        (in_hash,)).fetchall()
+    for (segment_id,) in rows:
+        files = {role: (path, size, mtime_ns) for role, path, size, mtime_ns
+                 in db.execute('SELECT role, path, size, mtime_ns FROM files '
+                               'WHERE segment_id = ?', (segment_id,))}
+        if all(role in files and files[role][1] is not None and
+               file_state(files[role][0]) == files[role][1:]
+               for role in roles):
+            return [files[role][0] for role in roles]
+    return None
+
+
+def intermediate_files(db, directory='.'):
+    # paths of the intermediate files of all runs in directory
+    rows = db.execute(
+        'SELECT DISTINCT files.path FROM files '
+        'JOIN segments ON files.segment_id = segments.id '
+        'JOIN runs ON segments.run_id = runs.id '
+        'WHERE runs.directory = ? AND files.role IN ({})'.format(
+            ', '.join('?' * len(INTERMEDIATE_ROLES))),
+        (os.path.abspath(directory),) + INTERMEDIATE_ROLES).fetchall()
+    return [row[0] for row in rows]
+
+
+def runs(db, directory=None):
+    # (id, in file, splits file, stitched file, started, state) of all
+    # runs, optionally only those in directory
+    query = ('SELECT id, in_file, splits_file, stitched, started, state '
+             'FROM runs')
+    if directory is None:
+        return db.execute(query + ' ORDER BY id').fetchall()
+    return db.execute(query + ' WHERE directory = ? ORDER BY id',
+                      (os.path.abspath(directory),)).fetchall()
+
+
+def segments(db, run_id):
+    # (name, lnmin, lnmax, in hash, state, returncode, runtime) of the
+    # segments of a run
+    return db.execute(
+        'SELECT name, lnmin, lnmax, in_hash, state, returncode, runtime '
+        'FROM segments WHERE run_id = ? ORDER BY name', (run_id,)).fetchall()
@@ -0,0 +1,227 @@
+import numpy as np
+import hashlib
+import json
+import os
+import zipfile
+'''
+v1.0
+18/10/2026
+Shared loader for the text files used with fd3 (.mod, .txt, .obs). Parsing
+these with np.loadtxt takes seconds for large files, so every parsed file is
+stored as a .npy file in a cache directory and memory-mapped on later loads.
+
+A cache entry is named after the path of the source file and its size and
+mtime, so editing or regenerating a file invalidates its entry. The cache is
+kept below CACHE_SIZE bytes by removing the least recently used entries.
+
+v1.1
+Binary container for stitched spectra (save_stitched/load_stitched).
+Memory-mapped FITS loading (load_fits, optionally with the header).
+'''
+
+CACHE_DIR = os.environ.get(
+    'FD3_CACHE_DIR',
+    os.path.join(os.path.expanduser('~'), '.cache', 'fd3-helper'))
+CACHE_SIZE = 2 * 1024**3  # bytes
+# suffix of the columnar stores of fd3_results.py, which aren't stitched
+# spectra although they are .npz files too
+RESULTS_SUFFIX = '.results.npz'
+
+
+def _digest(text):
+    return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+
+def cache_name(path):
+    '''
+    Returns the cache prefix of a file (only depends on its path) and the
+    full name of its cache entry (also depends on size and mtime).
+    '''
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    prefix = _digest(path)
+    return prefix, '{}-{}.npy'.format(
+        prefix, _digest('{} {}'.format(st.st_size, st.st_mtime_ns)))
+
+
+def load_table(path, cache_dir=None, max_size=None):
+    '''
+    Equivalent to np.loadtxt(path), but served from the cache when the file
+    hasn't changed since it was last parsed. Cached data is memory-mapped
+    read-only.
+    '''
+    if cache_dir is None:
+        cache_dir = CACHE_DIR
+    if max_size is None:
+        max_size = CACHE_SIZE
+
+    prefix, name = cache_name(path)
+    entry = os.path.join(cache_dir, name)
+
+    try:
+        data = np.load(entry, mmap_mode='r')
+        os.utime(entry)  # mark as recently used
+        return data
+    except (OSError, ValueError):
+        pass
+
+    data = np.loadtxt(path)
+
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        # entries of older versions of this file are useless now
+        for old in os.listdir(cache_dir):
+            if old.startswith(prefix + '-'):
+                os.remove(os.path.join(cache_dir, old))
+        # write to a temporary file first, so other processes never see a
+        # half written entry
+        tmp = '{}.{}.tmp'.format(entry, os.getpid())
+        with open(tmp, 'wb') as f:
+            np.save(f, data)
+        os.replace(tmp, entry)
+        evict(cache_dir, max_size)
+    except OSError:
+        # caching is optional, the data is loaded anyway
+        pass
+
+    return data
+
+
+def evict(cache_dir=None, max_size=None, suffix='.npy'):
+    # removes least recently used entries (files ending in suffix) until the
+    # cache fits in max_size
+    if cache_dir is None:
+        cache_dir = CACHE_DIR
+    if max_size is None:
+        max_size = CACHE_SIZE
+
+    try:
+        names = os.listdir(cache_dir)
+    except OSError:
+        return
+
+    entries = []
+    for name in names:
+        if not name.endswith(suffix):
+            continue
+        try:
+            st = os.stat(os.path.join(cache_dir, name))
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, name))
+
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in entries:
+        if total <= max_size:
+            break
+        try:
+            os.remove(os.path.join(cache_dir, name))
+        except OSError:
+            pass
+        total -= size
+
+
+def clear_cache(cache_dir=None):
+    evict(cache_dir, 0)
+
+
+def save_stitched(filename, lnw, s1, s2, boundaries=None, metadata=None):
+    '''
+    Saves stitched spectra in one uncompressed .npz file:
+        flux        (2, n) array with components A and B
+        lnw_start,  the ln(wavelength) grid, as start and step when it is
+        lnw_step    uniform (as fd3 grids are), else as the array lnw
+        boundaries  (n_segments, 2) ln(wavelength) range of every segment
+        metadata    JSON string with information about the run
+    The members are stored uncompressed, so load_stitched can memory-map
+    them.
+    '''
+    lnw = np.asarray(lnw, dtype=float)
+    data = {'flux': np.array([s1, s2], dtype=float)}
+
+    n = len(lnw)
+    step = (lnw[-1] - lnw[0]) / (n - 1) if n > 1 else 0.
+    if n > 1 and np.all(
+            np.abs(lnw - (lnw[0] + step * np.arange(n))) < 1e-3 * abs(step)):
+        data['lnw_start'] = np.array(lnw[0])
+        data['lnw_step'] = np.array(step)
+    else:
+        data['lnw'] = lnw
+
+    if boundaries is not None:
+        data['boundaries'] = np.asarray(boundaries, dtype=float)
+    data['metadata'] = np.array(json.dumps(metadata or {}))
+
+    np.savez(filename, **data)
+
+
+def mmap_npz(filename):
+    # memory-maps the uncompressed members of an .npz file; members that
+    # can't be mapped (compressed, or object arrays) are read normally
+    arrays = {}
+    with zipfile.ZipFile(filename) as archive, open(filename, 'rb') as f:
+        for info in archive.infolist():
+            name = info.filename[:-4]
+            if info.compress_type != zipfile.ZIP_STORED:
+                arrays[name] = np.load(archive.open(info))
+                continue
+            # skip the local header of the member to find the .npy data
+            f.seek(info.header_offset)
+            local = f.read(30)
+            offset = (info.header_offset + 30 +
+                      int.from_bytes(local[26:28], 'little') +
+                      int.from_bytes(local[28:30], 'little'))
+            f.seek(offset)
+            if np.lib.format.read_magic(f) == (1, 0):
+                header = np.lib.format.read_array_header_1_0(f)
+            else:
+                header = np.lib.format.read_array_header_2_0(f)
+            shape, fortran, dtype = header
+            if dtype.hasobject or not shape:
+                f.seek(offset)
+                arrays[name] = np.lib.format.read_array(f)
+            else:
+                arrays[name] = np.memmap(
+                    filename, dtype=dtype, mode='r', offset=f.tell(),
+                    shape=shape, order='F' if fortran else 'C')
+    return arrays
+
+
+def load_stitched(filename, mmap=True):
+    '''
+    Reads a file written by save_stitched. Returns a dict with lnw (the
+    ln(wavelength) grid), flux ((2, n) array, memory-mapped with mmap),
+    boundaries (or None) and metadata (a dict).
+    '''
+    if mmap:
+        data = mmap_npz(filename)
+    else:
+        with np.load(filename) as npz:
+            data = {name: npz[name] for name in npz.files}
+
+    if 'lnw' in data:
+        lnw = data['lnw']
+    else:
+        n = data['flux'].shape[1]
+        lnw = float(data['lnw_start']) + float(data['lnw_step']) * np.arange(n)
+
+    return {'lnw': lnw, 'flux': data['flux'],
+            'boundaries': data.get('boundaries'),
+            'metadata': json.loads(str(data['metadata']))}
+
+
+def load_fits(path, header=False):
+    '''
+    Opens a FITS spectrum (or stack of spectra) memory-mapped. Returns the
+    flux and the log-linear wavelength grid from the header: start (CRVAL1)
+    and step (CDELT1) in ln(wavelength), and with header also the whole
+    primary header. The file stays open as long as the flux is in use.
+    '''
+    from astropy.io import fits
+
+    h = fits.open(path, memmap=True)
+    primary = h[0].header
+    if header:
+        return h[0].data, primary['CRVAL1'], primary['CDELT1'], primary
+    return h[0].data, primary['CRVAL1'], primary['CDELT1']
@@ -0,0 +1,237 @@
+import numpy as np
+'''
+v1.0
+18/10/2026
+Continuum scaling shared by file2figure.py and the batch tools. All
+routines work on a single spectrum or on a 2-D stack of spectra (epoch x
+pixel) at once, and find the normalisation window as an index range, so the
+wavelengths of the whole spectrum never have to be computed.
+
+v1.1
+18/10/2026
+Shared by fd3_helper.py too: the first EDGE pixels of a segment, which
+stitching offsets to 1 (shift_window) and PointBrowser divides by.
+Continuum fitting for stacks of epochs: a running percentile of the flux in
+blocks of pixels, with pixels more than clip robust sigmas away (lines,
+cosmics) rejected and the percentile taken again, interpolated linearly
+between the blocks (continuum). normalize divides by either the window mean
+or the continuum, and normalize_chunked does the same block by block of
+pixels for stacks that don't fit in memory (e.g. memory-mapped), with the
+same result.
+'''
+
+WINDOW = (7500, 7550)  # Å, default normalisation window
+EDGE = slice(0, 20)  # first pixels of a segment, used to offset segments
+
+# defaults of the continuum fit
+BLOCK = 256  # pixels per block of the running percentile
+PERCENTILE = 90.
+CLIP = 3.  # sigmas
+ITERATIONS = 3
+CHUNK = 65536  # pixels per chunk in normalize_chunked
+
+
+def window_slice(start, step, n, window=WINDOW):
+    '''
+    Index range of the pixels with window[0] <= wavelength <= window[1] on a
+    log-linear grid of n pixels, ln(wavelength) = start + step * index (the
+    CRVAL1/CDELT1 header of a FITS spectrum).
+    '''
+    lo = int(np.ceil((np.log(window[0]) - start) / step))
+    hi = int(np.floor((np.log(window[1]) - start) / step)) + 1
+    return slice(min(max(lo, 0), n), min(max(hi, 0), n))
+
+
+def window_slice_array(w, window=WINDOW):
+    # the same for an ascending array of wavelengths
+    lo, hi = np.searchsorted(w, window[0], 'left'), \
+        np.searchsorted(w, window[1], 'right')
+    return slice(int(lo), int(hi))
+
+
+def window_mean(flux, index):
+    '''
+    Mean of every spectrum in flux (1-D, or 2-D with one spectrum per row)
+    over the pixels index (a slice), with keepdims. Every mean is taken of
+    its own 1-D slice, so it is bit-for-bit the same as for one spectrum
+    (a mean along an axis of a 2-D array sums in another order).
+    '''
+    flux = np.asarray(flux)
+    if index.stop <= index.start:
+        raise ValueError('normalisation window outside the spectrum')
+    window = flux[..., index]
+    means = [np.mean(row) for row in window.reshape(-1, window.shape[-1])]
+    return np.array(means).reshape(flux.shape[:-1] + (1,))
+
+
+def window_scale(flux, index):
+    '''
+    Factors that divide every spectrum in flux (1-D, or 2-D with one
+    spectrum per row) by its mean over the pixels index (a slice).
+    '''
+    return 1 / window_mean(flux, index)
+
+
+def scale_window(flux, index):
+    # flux divided by its mean over the pixels index, per spectrum
+    return np.asarray(flux) * window_scale(flux, index)
+
+
+def window_shift(flux, index):
+    # offsets that bring the mean of every spectrum over index to 1
+    return 1 - window_mean(flux, index)
+
+
+def shift_window(flux, index):
+    # flux offset so its mean over the pixels index is 1, per spectrum
+    return np.asarray(flux) + window_shift(flux, index)
+
+
+def block_percentile(flux, block, q):
+    '''
+    The q-th percentile (like np.nanpercentile, ignoring NaN) of every block
+    of block pixels of every spectrum in flux (2-D). Returns an (epochs,
+    blocks) array, NaN for blocks without valid pixels; the last block may
+    be shorter. All blocks are sorted at once, which is much faster than
+    np.nanpercentile over an axis.
+    '''
+    n_epochs, n = flux.shape
+    n_blocks = -(-n // block)
+    padded = np.full((n_epochs, n_blocks * block), np.nan)
+    padded[:, :n] = flux
+    values = np.sort(padded.reshape(n_epochs, n_blocks, block), axis=-1)
+
+    # NaN sort to the end; interpolate between the valid values
+    valid = np.count_nonzero(~np.isnan(values), axis=-1)
+    position = np.maximum(valid - 1, 0) * q / 100.
+    lower = np.floor(position).astype(int)
+    upper = np.minimum(lower + 1, np.maximum(valid - 1, 0))
+    fraction = position - lower
+    low = np.take_along_axis(values, lower[..., None], -1)[..., 0]
+    high = np.take_along_axis(values, upper[..., None], -1)[..., 0]
+    return np.where(valid > 0, low + (high - low) * fraction, np.nan)
+
+
+def interpolate_blocks(values, n, block):
+    '''
+    Linear interpolation of per-block values (epochs x blocks, centred on
+    the blocks) to the n pixels of every spectrum, the same weights for
+    all epochs.
+    '''
+    n_blocks = values.shape[1]
+    centres = (np.arange(n_blocks) + 0.5) * block - 0.5
+    x = np.clip(np.arange(n), centres[0], centres[-1])
+    right = np.clip(np.searchsorted(centres, x, 'right'), 1,
+                    max(n_blocks - 1, 1))
+    left = right - 1
+    if n_blocks == 1:
+        return np.repeat(values[:, :1], n, axis=1)
+    t = (x - centres[left]) / (centres[right] - centres[left])
+    return values[:, left] * (1 - t) + values[:, right] * t
+
+
+def fill_blocks(values):
+    # replaces NaN blocks (all pixels rejected) by their neighbours
+    values = np.array(values, dtype=float)
+    for row in values:
+        bad = np.isnan(row)
+        if bad.all():
+            row[:] = 1.
+        elif bad.any():
+            good = np.flatnonzero(~bad)
+            row[bad] = np.interp(np.flatnonzero(bad), good, row[good])
+    return values
+
+
+def continuum(flux, block=BLOCK, percentile=PERCENTILE, clip=CLIP,
+              iterations=ITERATIONS, offset=0):
+    '''
+    Continuum of every spectrum in flux (1-D, or 2-D with one spectrum per
+    row): the percentile of the flux in blocks of block pixels,
+    interpolated between the block centres. Each iteration rejects pixels
+    more than clip robust sigmas (1.4826 times the median absolute
+    deviation in their block) from the continuum and takes the
+    percentiles again. offset is the index of the first pixel in a longer
+    spectrum; blocks start at multiples of block of the full spectrum.
+    '''
+    flux = np.asarray(flux, dtype=float)
+    single = flux.ndim == 1
+    flux = np.atleast_2d(flux)
+    n = flux.shape[1]
+
+    # align the blocks to the full spectrum
+    lead = offset % block
+    aligned = np.full((flux.shape[0], lead + n), np.nan)
+    aligned[:, lead:] = flux
+
+    def level(values, q):
+        return fill_blocks(block_percentile(values, block, q))
+
+    values = level(aligned, percentile)
+    for i in range(iterations):
+        residual = aligned - interpolate_blocks(values, lead + n, block)
+        deviation = np.abs(residual - interpolate_blocks(
+            level(residual, 50), lead + n, block))
+        sigma = 1.4826 * interpolate_blocks(level(deviation, 50), lead + n,
+                                            block)
+        values = level(np.where(np.abs(residual) <= clip * sigma, aligned,
+                                np.nan), percentile)
+
+    result = interpolate_blocks(values, lead + n, block)[:, lead:]
+    return result[0] if single else result
+
+
+def normalize(flux, method='window', index=None, **options):
+    '''
+    flux (1-D or epochs x pixels) divided by the mean over the pixels index
+    (method 'window') or by its continuum (method 'continuum', options as
+    for continuum).
+    '''
+    if method == 'window':
+        return scale_window(flux, index)
+    if method == 'continuum':
+        return np.asarray(flux) / continuum(flux, **options)
+    raise ValueError("unknown normalisation '{}'".format(method))
+
+
+def normalize_chunked(flux, out=None, method='window', index=None,
+                      chunk=CHUNK, block=BLOCK, **options):
+    '''
+    normalize for an (epochs x pixels) array that doesn't fit in memory,
+    e.g. memory-mapped: chunk pixels of all epochs are read, normalised and
+    written to out (default: flux itself) at a time. The continuum of every
+    chunk is fitted with two blocks of margin on both sides, read from the
+    original flux (the left margin is kept from the previous chunk, as it
+    may be normalised already), so the result is the same as for the whole
+    array. Returns out.
+    '''
+    if out is None:
+        out = flux
+    n = flux.shape[1]
+
+    if method == 'window':
+        scale = window_scale(flux, index)
+        for lo in range(0, n, chunk):
+            hi = min(lo + chunk, n)
+            out[:, lo:hi] = np.asarray(flux[:, lo:hi]) * scale
+        return out
+    if method != 'continuum':
+        raise ValueError("unknown normalisation '{}'".format(method))
+
+    # chunks of whole blocks, so all chunks use the same blocks
+    chunk = max(chunk // block, 1) * block
+    margin = 2 * block * (1 + options.get('iterations', ITERATIONS))
+    tail = np.empty((flux.shape[0], 0))  # original flux left of the chunk
+    for lo in range(0, n, chunk):
+        hi = min(lo + chunk, n)
+        first, last = max(lo - margin, 0), min(hi + margin, n)
+        # not written yet, copied as out may be flux
+        right = np.array(flux[:, lo:last], dtype=float)
+        part = np.concatenate([tail[:, tail.shape[1] - (lo - first):],
+                               right], axis=1)
+        fit = continuum(part, block=block, offset=first, **options)
+        tail = np.concatenate([tail, right[:, :hi - lo]],
+                              axis=1)[:, -margin:]
+        out[:, lo:hi] = part[:, lo - first:hi - first] / \
+            fit[:, lo - first:hi - first]
+    return out
@@ -0,0 +1,233 @@
+import argparse
+import functools
+import glob
+import multiprocessing as mp
+import os
+import tempfile
+import numpy as np
+import fd3_norm
+from fd3_loader import load_fits
+'''
+v1.0
+18/10/2026
+Builds the master .obs file for fd3 from a set of FITS spectra with
+log-linear wavelength headers (CRVAL1/CDELT1 in ln(wavelength), like
+file2figure's fitsfig reads them).
+
+The headers are read in a process pool, and the common ln(wavelength) grid
+is the overlap of all spectra (optionally trimmed to the working range,
+4000-6850 Å) with the median step. In a second pass every worker resamples
+one spectrum, memory-mapped, onto that grid with np.interp and writes it
+into a shared scratch array. The .obs file is then streamed out in chunks
+of rows: a '# ncols X nrows' header, and rows of ln(wavelength) followed by
+one flux column per epoch, in time order.
+
+The spectra can be normalised on the way (see fd3_norm.py), by the mean in
+a window or by a fitted continuum, in chunks of pixels of all epochs.
+
+The epoch lines for the .in file ('time 0 1 lfA lfB') are written from the
+header dates, and with a template .in file a complete .in file for the new
+.obs file.
+
+    python fd3_obs.py 'spectra/*.fits' --out sig_aql.obs --trim \
+        --normalize continuum --template sig_aql.in
+'''
+
+WORKING_RANGE = (4000, 6850)  # Å
+LIGHT = (.67, .33)  # light factors of new epoch lines
+CHUNK = 65536  # rows per write
+
+# header keywords with the time of an observation, and the offset to JD
+TIME_KEYS = [('HJD', 0.), ('BJD', 0.), ('JD', 0.), ('MJD-OBS', 2400000.5)]
+
+
+def header_time(header):
+    # Julian date of an observation from its FITS header
+    for key, offset in TIME_KEYS:
+        if key in header:
+            return float(header[key]) + offset
+    if 'DATE-OBS' in header:
+        from astropy.time import Time
+        return float(Time(header['DATE-OBS']).jd)
+    raise ValueError('no observation date in header')
+
+
+def read_grid(path):
+    # (start, step, pixels, time) of a FITS spectrum
+    flux, start, step, header = load_fits(path, header=True)
+    return float(start), float(step), int(flux.shape[-1]), \
+        header_time(header)
+
+
+def common_grid(grids, trim=None, step=None):
+    '''
+    The ln(wavelength) grid (start, step, n) covered by all spectra of
+    grids ((start, step, pixels, ...) each), trimmed to trim (Å, min and
+    max) when given. step defaults to the median step of the spectra.
+    '''
+    starts = np.array([g[0] for g in grids])
+    steps = np.array([g[1] for g in grids])
+    ends = starts + steps * (np.array([g[2] for g in grids]) - 1)
+    lo, hi = starts.max(), ends.min()
+    if trim is not None:
+        lo, hi = max(lo, np.log(trim[0])), min(hi, np.log(trim[1]))
+    if hi <= lo:
+        raise ValueError('the spectra have no wavelengths in common')
+    if step is None:
+        step = float(np.median(steps))
+    n = int(np.floor((hi - lo) / step + 1e-9)) + 1
+    return float(lo), step, n
+
+
+def resample(job, grid, scratch):
+    # resamples one spectrum onto grid and writes it to its row of scratch
+    row, path = job
+    flux, start, step = load_fits(path)
+    flux = np.asarray(flux, dtype=float).ravel()
+    x = start + step * np.arange(len(flux))
+    target = grid[0] + grid[1] * np.arange(grid[2])
+    out = np.load(scratch, mmap_mode='r+')
+    out[row] = np.interp(target, x, flux)
+    out.flush()
+
+
+def write_obs(filename, grid, matrix, fmt='%.10f', chunk=CHUNK):
+    # streams the .obs file: the header, then ln(wavelength) and the flux
+    # of every epoch per row, chunk rows at a time
+    n_epochs, n = matrix.shape
+    with open(filename, 'w') as f:
+        f.write('# {} X {}\n'.format(n_epochs + 1, n))
+        for lo in range(0, n, chunk):
+            hi = min(lo + chunk, n)
+            block = np.empty((hi - lo, n_epochs + 1))
+            block[:, 0] = grid[0] + grid[1] * np.arange(lo, hi)
+            block[:, 1:] = matrix[:, lo:hi].T
+            np.savetxt(f, block, fmt=fmt)
+
+
+def epoch_lines(times, light=LIGHT):
+    # the epoch lines of an .in file for the given times
+    return ['{:.12f} 0 1 {} {}\n'.format(t, *light) for t in times]
+
+
+def write_in(filename, template, obsfile, grid, times):
+    '''
+    Writes an .in file like template, with the .obs file, its ln(wavelength)
+    range and its epochs (with the light factors of the first epoch line of
+    template).
+    '''
+    import fd3_helper
+
+    with open(template, 'r') as f:
+        lines = f.readlines()
+    first, epochs, orbit, last = fd3_helper.in_layout(lines)
+    light = lines[epochs[0]].split()[3:5] if epochs else LIGHT
+
+    firstline = lines[first].split()
+    firstline[0:3] = [obsfile, repr(grid[0]),
+                      repr(grid[0] + grid[1] * (grid[2] - 1))]
+    new = ['  '.join(firstline) + '\n']
+    new += lines[first + 1:epochs[0] if epochs else first + 1]
+    new += epoch_lines(times, light)
+    new += lines[(epochs[-1] + 1) if epochs else first + 1:]
+    with open(filename, 'w') as f:
+        f.writelines(new)
+
+
+def build(fitsfiles, obsfile, trim=None, step=None, processes=None,
+          template=None, infile=None, normalize=None,
+          window=fd3_norm.WINDOW):
+    '''
+    Builds the .obs file obsfile from fitsfiles (see above) and writes the
+    epoch lines to obsfile[:-4] + '_epochs.txt', and an .in file infile
+    (default obsfile[:-4] + '.in') when a template .in file is given.
+    normalize is None, 'window' (divide by the mean in window, Å) or
+    'continuum' (divide by the fitted continuum).
+    Returns the grid (start, step, n) and the epoch times.
+    '''
+    pool = mp.Pool(processes)
+    grids = pool.map(read_grid, fitsfiles)
+    if not grids:
+        raise ValueError('no FITS files given')
+
+    # columns in time order
+    order = np.argsort([g[3] for g in grids], kind='stable')
+    fitsfiles = [fitsfiles[i] for i in order]
+    times = [grids[i][3] for i in order]
+    grid = common_grid(grids, trim, step)
+    print("{} spectra, {} pixels from {:.2f} to {:.2f} A".format(
+        len(fitsfiles), grid[2], np.exp(grid[0]),
+        np.exp(grid[0] + grid[1] * (grid[2] - 1))))
+
+    # checked before any spectrum is resampled
+    index = None
+    if normalize == 'window':
+        index = fd3_norm.window_slice(*grid, window=window)
+        if index.stop <= index.start:
+            pool.terminate()
+            raise ValueError(
+                "normalisation window {}-{} A outside the grid "
+                "({:.2f}-{:.2f} A)".format(
+                    window[0], window[1], np.exp(grid[0]),
+                    np.exp(grid[0] + grid[1] * (grid[2] - 1))))
+
+    directory = os.path.dirname(os.path.abspath(obsfile))
+    fd, scratch = tempfile.mkstemp(suffix='.npy', dir=directory)
+    os.close(fd)
+    try:
+        np.lib.format.open_memmap(scratch, mode='w+', dtype=float,
+                                  shape=(len(fitsfiles), grid[2])).flush()
+        pool.map(functools.partial(resample, grid=grid, scratch=scratch),
+                 enumerate(fitsfiles))
+        pool.close()
+        pool.join()
+        if normalize is not None:
+            matrix = np.load(scratch, mmap_mode='r+')
+            fd3_norm.normalize_chunked(matrix, method=normalize,
+                                       index=index)
+            matrix.flush()
+            del matrix
+        write_obs(obsfile, grid, np.load(scratch, mmap_mode='r'))
+    finally:
+        os.remove(scratch)
+
+    with open(obsfile[:-4] + '_epochs.txt', 'w') as f:
+        f.writelines(epoch_lines(times))
+    if template is not None:
+        write_in(infile or obsfile[:-4] + '.in', template, obsfile, grid,
+                 times)
+    return grid, times
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Build an fd3 .obs file from FITS spectra')
+    parser.add_argument('fits', nargs='+', help='FITS files (or globs)')
+    parser.add_argument('--out', default='spectra.obs')
+    parser.add_argument('--trim', action='store_true',
+                        help='trim to {}-{} A'.format(*WORKING_RANGE))
+    parser.add_argument('--step', type=float, default=None,
+                        help='ln(wavelength) step of the grid')
+    parser.add_argument('--normalize', choices=('window', 'continuum'),
+                        default=None)
+    parser.add_argument('--window', type=float, nargs=2,
+                        default=fd3_norm.WINDOW, metavar=('LO', 'HI'),
+                        help='normalisation window (A), inside the grid')
+    parser.add_argument('--template', default=None,
+                        help='.in file to copy for the new .in file')
+    parser.add_argument('--processes', type=int, default=None)
+    args = parser.parse_args()
+
+    fitsfiles = sorted(set(name for pattern in args.fits
+                           for name in glob.glob(pattern)))
+    try:
+        build(fitsfiles, args.out, WORKING_RANGE if args.trim else None,
+              args.step, args.processes, args.template,
+              normalize=args.normalize, window=args.window)
+    except ValueError as error:
+        parser.exit(1, "### {} ###\n".format(error))
+    print("Saved '{}'".format(args.out))
+
+
+if __name__ == '__main__':
+    main()
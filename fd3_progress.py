@@ -0,0 +1,211 @@
+import json
+import os
+import re
+import threading
+import time
+'''
+v1.0
+18/10/2026
+Live progress of running fd3 jobs. The stdout and the .log file of every
+job are followed while fd3 runs, and lines with simplex progress,
+
+    <restart> <iteration> <chi2> [parameters ...]
+
+are parsed. The latest state of every segment is written to a small
+<segment>.progress file (JSON), which segment_progress reads, also for jobs
+that run on other hosts through fd3_queue.
+
+A ConvergenceMonitor can stop jobs early: when the best chi2 hasn't
+improved by more than a relative plateau_tol over the last plateau_window
+progress lines, or when chi2 becomes non-finite or grows beyond
+diverge_factor times its first value. fd3 writes no outputs when it is
+terminated, so fd3_helper finishes a plateaued job with a short run from
+its best fit so far.
+'''
+
+PROGRESS_PATTERN = re.compile(r'^\s*(\d+)\s+(\d+)\s+(\S+)')
+UPDATE_INTERVAL = 1.  # seconds between writes of a .progress file
+
+
+def parse_progress(line):
+    # (restart, iteration, chi2) of a progress line, or None
+    match = PROGRESS_PATTERN.match(line)
+    if match is None:
+        return None
+    try:
+        chi2 = float(match.group(3))
+    except ValueError:
+        return None
+    return int(match.group(1)), int(match.group(2)), chi2
+
+
+def best_fit(logfile):
+    '''
+    (chi2, parameters) of the progress line with the lowest chi2 in an fd3
+    .log file, or None when it has none. parameters are the numbers after
+    chi2 on that line.
+    '''
+    best = None
+    try:
+        with open(logfile, 'r') as f:
+            for line in f:
+                progress = parse_progress(line)
+                if progress is None or progress[2] != progress[2]:
+                    continue
+                if best is None or progress[2] < best[0]:
+                    try:
+                        params = [float(x) for x in line.split()[3:]]
+                    except ValueError:
+                        continue
+                    best = (progress[2], params)
+    except OSError:
+        return None
+    return best
+
+
+class ConvergenceMonitor(object):
+    """
+    Decides from the stream of chi2 values whether a job has converged
+    (plateau) or is diverging. update() returns 'plateau', 'diverging' or
+    None. Leave plateau_window or diverge_factor at None to disable that
+    test.
+    """
+
+    def __init__(self, plateau_window=None, plateau_tol=1e-4,
+                 diverge_factor=None):
+        self.plateau_window = plateau_window
+        self.plateau_tol = plateau_tol
+        self.diverge_factor = diverge_factor
+        self.history = []
+
+    def update(self, chi2):
+        self.history.append(chi2)
+
+        if self.diverge_factor is not None:
+            if chi2 != chi2 or chi2 in (float('inf'), float('-inf')):
+                return 'diverging'
+            if chi2 > self.diverge_factor * abs(self.history[0]):
+                return 'diverging'
+
+        if self.plateau_window is not None and \
+                len(self.history) > self.plateau_window:
+            before = min(self.history[:-self.plateau_window])
+            best = min(before, min(self.history[-self.plateau_window:]))
+            if before - best <= self.plateau_tol * abs(before):
+                return 'plateau'
+
+        return None
+
+
+class ProgressTracker(object):
+    """
+    Collects the progress of one fd3 run from its output lines and writes
+    it to the .progress file of the segment. on_stop(reason) is called once
+    when the monitor asks to stop the job.
+    """
+
+    def __init__(self, name, monitor=None, on_stop=None):
+        self.filename = name[:-3] + '.progress'
+        self.monitor = monitor
+        self.on_stop = on_stop
+        self.lock = threading.Lock()
+        self.state = {'segment': name, 'state': 'running', 'restart': None,
+                      'iteration': None, 'chi2': None, 'best': None,
+                      'lines': 0, 'started': time.time()}
+        self.stopped = None
+        self.written = 0.
+        self.write(force=True)
+
+    def feed(self, line):
+        progress = parse_progress(line)
+        if progress is None:
+            return
+        with self.lock:
+            restart, iteration, chi2 = progress
+            # stdout and the .log file may both report the same step
+            last = (self.state['restart'], self.state['iteration'])
+            if last[0] is not None and (restart, iteration) <= last:
+                return
+            self.state.update(restart=restart, iteration=iteration, chi2=chi2,
+                              lines=self.state['lines'] + 1)
+            if self.state['best'] is None or chi2 < self.state['best']:
+                self.state['best'] = chi2
+            reason = None
+            if self.monitor is not None and self.stopped is None:
+                reason = self.monitor.update(chi2)
+                if reason is not None:
+                    self.stopped = reason
+                    self.state['state'] = reason
+        if reason is not None and self.on_stop is not None:
+            self.on_stop(reason)
+        self.write(force=reason is not None)
+
+    def write(self, force=False, state=None):
+        now = time.time()
+        if not force and now - self.written < UPDATE_INTERVAL:
+            return
+        with self.lock:
+            if state is not None:
+                self.state['state'] = state
+            self.state['updated'] = now
+            data = dict(self.state)
+        self.written = now
+        tmp = '{}.{}.tmp'.format(self.filename, os.getpid())
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp, self.filename)
+        except OSError:
+            pass
+
+
+def follow_file(filename, callback, stop, interval=0.5):
+    '''
+    Calls callback(line) for every line appended to filename until stop
+    is set, like tail -f. The file may not exist yet. Lines written before
+    the call are skipped only if the file existed already.
+    '''
+    position = os.path.getsize(filename) if os.path.exists(filename) else 0
+    partial = ''
+    while True:
+        finished = stop.wait(interval)
+        try:
+            size = os.path.getsize(filename)
+            if size < position:
+                # the file was rewritten
+                position = 0
+            with open(filename, 'r') as f:
+                f.seek(position)
+                data = f.read()
+                position = f.tell()
+        except OSError:
+            data = ''
+        lines = (partial + data).split('\n')
+        partial = lines.pop()
+        for line in lines:
+            callback(line)
+        if finished:
+            return
+
+
+def segment_progress(filenames):
+    # the latest progress of every .in file in filenames (None if unknown)
+    progress = {}
+    for name in filenames:
+        try:
+            with open(name[:-3] + '.progress', 'r') as f:
+                progress[name] = json.load(f)
+        except (OSError, ValueError):
+            progress[name] = None
+    return progress
+
+
+def print_progress(filenames):
+    # one line per segment with its state, iteration and chi2
+    for name, state in sorted(segment_progress(filenames).items()):
+        if state is None:
+            print('{}  waiting'.format(name))
+            continue
+        print('{}  {:10s} restart {}  iteration {}  chi2 {}  best {}'.format(
+            name, state['state'], state['restart'], state['iteration'],
+            state['chi2'], state['best']))
@@ -0,0 +1,196 @@
+import numpy as np
+import os
+import fd3_loader
+'''
+v1.0
+18/10/2026
+Min/max pyramids for viewing large spectra. Level k of the pyramid of a
+spectrum holds, for every block of 2**k pixels, the position and value of
+its minimum and maximum. A view only plots the level at which the visible
+part of the spectrum has about one block per screen pixel, which looks the
+same as plotting every pixel but costs the same for any file size.
+
+Pyramids are saved in the cache directory of fd3_loader, keyed on the path,
+size and mtime of the data file like the parsed text files, and are
+memory-mapped when loaded again.
+'''
+
+PYRAMID_DIR = os.path.join(fd3_loader.CACHE_DIR, 'pyramids')
+PYRAMID_CACHE_SIZE = 1024**3  # bytes
+MIN_POINTS = 1024  # no levels with fewer blocks than this
+
+
+class LogLinearGrid(object):
+    """
+    Wavelengths of a log-linear grid (like the CRVAL1/CDELT1 header of a
+    FITS spectrum) that are only computed for the pixels that are asked
+    for. Can be used in place of a wavelength array in PyramidPlot.
+    """
+
+    def __init__(self, start, step, n):
+        self.start = start
+        self.step = step
+        self.n = n
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            index = np.arange(*index.indices(self.n))
+        return np.exp(self.start + self.step * np.asarray(index))
+
+    def searchsorted(self, values):
+        index = np.ceil((np.log(values) - self.start) / self.step)
+        return np.clip(index, 0, self.n).astype(int)
+
+
+def build_levels(y, min_points=MIN_POINTS):
+    '''
+    Returns the levels 1, 2, ... of the pyramid of y, as a list of
+    (imin, imax, ymin, ymax) arrays with one entry per block.
+    '''
+    y = np.asarray(y)
+    levels = []
+    # level 0: every pixel is its own minimum and maximum
+    imin = imax = np.arange(len(y))
+    ymin = ymax = y
+    while len(ymin) // 2 >= min_points:
+        m = len(ymin) // 2 * 2
+        # the better of each pair of blocks
+        lower = ymin[1:m:2] < ymin[0:m:2]
+        higher = ymax[1:m:2] > ymax[0:m:2]
+        imin = np.where(lower, imin[1:m:2], imin[0:m:2])
+        ymin = np.where(lower, ymin[1:m:2], ymin[0:m:2])
+        imax = np.where(higher, imax[1:m:2], imax[0:m:2])
+        ymax = np.where(higher, ymax[1:m:2], ymax[0:m:2])
+        levels.append((imin, imax, ymin, ymax))
+    return levels
+
+
+def load_pyramid(path, ys, cache_dir=None, max_size=None):
+    '''
+    Pyramids (see build_levels) of the columns ys of the data file path,
+    from the cache when the file hasn't changed, else built and cached.
+    '''
+    if cache_dir is None:
+        cache_dir = PYRAMID_DIR
+    if max_size is None:
+        max_size = PYRAMID_CACHE_SIZE
+
+    prefix, name = fd3_loader.cache_name(path)
+    entry = os.path.join(cache_dir, name[:-4] + '.npz')
+
+    try:
+        data = fd3_loader.mmap_npz(entry)
+        os.utime(entry)  # mark as recently used
+        return [unpack(data, c) for c in range(len(ys))]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    pyramids = [build_levels(y) for y in ys]
+
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        for old in os.listdir(cache_dir):
+            if old.startswith(prefix + '-'):
+                os.remove(os.path.join(cache_dir, old))
+        arrays = {}
+        for c, levels in enumerate(pyramids):
+            arrays['c{}_levels'.format(c)] = np.array(len(levels))
+            for k, level in enumerate(levels):
+                for part, values in zip(('imin', 'imax', 'ymin', 'ymax'),
+                                        level):
+                    arrays['c{}_l{}_{}'.format(c, k, part)] = values
+        tmp = '{}.{}.tmp'.format(entry, os.getpid())
+        with open(tmp, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp, entry)
+        fd3_loader.evict(cache_dir, max_size, suffix='.npz')
+    except OSError:
+        pass
+
+    return pyramids
+
+
+def unpack(data, c):
+    # the levels of column c from the arrays of a cached pyramid
+    return [tuple(data['c{}_l{}_{}'.format(c, k, part)]
+                  for part in ('imin', 'imax', 'ymin', 'ymax'))
+            for k in range(int(data['c{}_levels'.format(c)]))]
+
+
+def view(x, y, levels, lo, hi, n_pixels, scale=1.):
+    '''
+    Points to plot for the part lo <= x <= hi at a width of n_pixels: the
+    raw data when it has few enough points, else the minima and maxima of
+    the coarsest level that still has about one block per pixel.
+    '''
+    start, stop = x.searchsorted([lo, hi])
+    start = max(int(start) - 1, 0)
+    stop = min(int(stop) + 1, len(x))
+
+    k = 0
+    while k < len(levels) and (stop - start) >> k > 2 * n_pixels:
+        k += 1
+    if k == 0:
+        return x[start:stop], np.asarray(y[start:stop]) * scale
+
+    imin, imax, ymin, ymax = levels[k - 1]
+    first = start >> k
+    last = min((stop >> k) + 1, len(imin))
+    index = np.concatenate([imin[first:last], imax[first:last]])
+    values = np.concatenate([ymin[first:last], ymax[first:last]])
+    order = np.argsort(index, kind='stable')
+    return x[index[order]], values[order] * scale
+
+
+class PyramidPlot(object):
+    """
+    Lines of one or more spectra on a shared wavelength axis that are
+    redrawn from their pyramids whenever the x-limits change.
+    """
+
+    def __init__(self, ax, x, ys, pyramids, scales=None, styles=None):
+        self.ax = ax
+        self.x = x
+        self.ys = ys
+        self.pyramids = pyramids
+        self.scales = scales or [1.] * len(ys)
+        styles = styles or [''] * len(ys)
+
+        self.lines = [ax.plot([], [], style)[0] for style in styles]
+
+        # limits of the full data, from the coarsest levels
+        lows = []
+        highs = []
+        for y, levels, scale in zip(ys, pyramids, self.scales):
+            if levels:
+                lows.append(np.min(levels[-1][2]) * scale)
+                highs.append(np.max(levels[-1][3]) * scale)
+            else:
+                lows.append(np.min(y) * scale)
+                highs.append(np.max(y) * scale)
+        lo, hi = min(lows), max(highs)
+        margin = 0.05 * (hi - lo)
+        ax.set_ylim(lo - margin, hi + margin)
+
+        ax.callbacks.connect('xlim_changed', self.refresh)
+        ax.set_xlim(x[0], x[len(x) - 1])
+
+    def refresh(self, ax):
+        lo, hi = ax.get_xlim()
+        n_pixels = max(int(ax.bbox.width), 100)
+        for line, y, levels, scale in zip(self.lines, self.ys,
+                                          self.pyramids, self.scales):
+            line.set_data(*view(self.x, y, levels, lo, hi, n_pixels, scale))
+        ax.figure.canvas.draw_idle()
+
+
+def plot(path, x, ys, scales=None, styles=None, ax=None):
+    # plots the columns ys of the data file path, with a cached pyramid
+    import matplotlib.pyplot as plt
+
+    if ax is None:
+        ax = plt.gca()
+    return PyramidPlot(ax, x, ys, load_pyramid(path, ys), scales, styles)
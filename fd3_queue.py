@@ -0,0 +1,241 @@
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+'''
+v1.0
+18/10/2026
+File based work queue, so fd3 segments can run on several machines that
+mount the same filesystem. The queue is a directory with three
+subdirectories:
+
+    pending/  jobs waiting for a worker
+    claimed/  jobs being run; a worker claims a job by renaming it from
+              pending/, which only one worker can do, and keeps touching it
+              while fd3 runs (heartbeat)
+    done/     the status of every finished job (see fd3_helper.fd3)
+
+A claimed job whose heartbeat is older than the lease is put back in
+pending/ by the coordinator, so jobs of crashed workers or lost hosts are run
+again. Job names start with their rank, so workers take the largest
+segments first.
+
+Start any number of workers, on any host, with
+
+    python fd3_queue.py worker /shared/queue
+
+and run fd3_helper with the queue executor, pointing at the same directory.
+The working directory of the run must have the same path on all hosts.
+'''
+
+HEARTBEAT = 10.  # seconds between heartbeats of a worker
+LEASE = 60.  # seconds without heartbeat after which a job is run again
+POLL = 1.  # seconds between scans of the queue
+
+
+def queue_dirs(queue_dir):
+    dirs = [os.path.join(queue_dir, sub) for sub in
+            ('pending', 'claimed', 'done')]
+    for d in dirs:
+        os.makedirs(d, exist_ok=True)
+    return dirs
+
+
+def write_json(filename, data):
+    # write and rename, so readers never see half a file
+    tmp = '{}.{}.tmp'.format(filename, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, filename)
+
+
+def read_json(filename):
+    with open(filename, 'r') as f:
+        return json.load(f)
+
+
+def last_heard(filename):
+    # a claim (rename) updates the ctime, a heartbeat (touch) both times
+    st = os.stat(filename)
+    return max(st.st_mtime, st.st_ctime)
+
+
+def submit(queue_dir, filenames, timeout=None, retries=1, convergence=None):
+    '''
+    Puts the .in files in the queue in the given order, to be run in the
+    current working directory. Returns the names of the jobs.
+    '''
+    pending, _, _ = queue_dirs(queue_dir)
+    run = '{}-{}-{}'.format(socket.gethostname(), os.getpid(),
+                            int(time.time()))
+    jobs = []
+    for rank, name in enumerate(filenames):
+        job = '{:06d}-{}-{}.json'.format(rank, run, os.path.basename(name))
+        write_json(os.path.join(pending, job), {
+            'name': name, 'cwd': os.getcwd(), 'timeout': timeout,
+            'retries': retries, 'convergence': convergence,
+            'submitted': time.time()})
+        jobs.append(job)
+    return jobs
+
+
+def requeue_expired(queue_dir, lease=LEASE):
+    # puts claimed jobs without a recent heartbeat back in pending/
+    pending, claimed, done = queue_dirs(queue_dir)
+    now = time.time()
+    for job in os.listdir(claimed):
+        path = os.path.join(claimed, job)
+        try:
+            if now - last_heard(path) < lease:
+                continue
+            if os.path.exists(os.path.join(done, job)):
+                os.remove(path)
+            else:
+                os.rename(path, os.path.join(pending, job))
+                print("\n### lease of {} expired, job requeued ###".format(
+                    job))
+        except OSError:
+            # the worker finished or another coordinator got there first
+            pass
+
+
+def collect(queue_dir, jobs, lease=LEASE, poll=POLL, idle=None):
+    '''
+    Waits for the jobs and yields their statuses as they finish, in any
+    order. Expired leases are requeued while waiting, and idle() is called
+    on every scan that found nothing new.
+    '''
+    _, _, done = queue_dirs(queue_dir)
+    remaining = set(jobs)
+    while remaining:
+        finished = remaining.intersection(os.listdir(done))
+        for job in sorted(finished):
+            remaining.discard(job)
+            status = read_json(os.path.join(done, job))
+            os.remove(os.path.join(done, job))
+            yield status
+        if remaining and not finished:
+            requeue_expired(queue_dir, lease)
+            if idle is not None:
+                idle()
+            time.sleep(poll)
+
+
+def start_local_workers(queue_dir, n):
+    # worker processes on this machine, which stop when the queue is empty
+    return [subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                              'worker', queue_dir, '--exit-when-empty'])
+            for _ in range(n)]
+
+
+def run_jobs(queue_dir, filenames, timeout=None, retries=1, local_workers=0,
+             convergence=None, lease=LEASE, poll=POLL):
+    '''
+    Coordinator side: submits the .in files (largest first, as ordered by
+    the caller), optionally starts local_workers worker processes on this
+    machine, and yields the statuses of the jobs as they finish.
+    '''
+    jobs = submit(queue_dir, filenames, timeout, retries, convergence)
+    workers = start_local_workers(queue_dir, local_workers)
+
+    def idle():
+        # local workers stop once pending/ is empty; start them again when
+        # jobs of a lost worker were requeued
+        if workers and all(worker.poll() is not None for worker in workers):
+            if os.listdir(os.path.join(queue_dir, 'pending')):
+                workers[:] = start_local_workers(queue_dir, local_workers)
+
+    try:
+        for status in collect(queue_dir, jobs, lease, poll, idle):
+            yield status
+    finally:
+        for worker in workers:
+            worker.wait()
+
+
+def claim(queue_dir):
+    # claims the first pending job; returns its name or None
+    pending, claimed, _ = queue_dirs(queue_dir)
+    for job in sorted(os.listdir(pending)):
+        if job.endswith('.tmp'):
+            continue
+        try:
+            os.rename(os.path.join(pending, job), os.path.join(claimed, job))
+        except OSError:
+            # another worker was faster
+            continue
+        return job
+    return None
+
+
+def heartbeat(path, stop, interval=HEARTBEAT):
+    while not stop.wait(interval):
+        try:
+            os.utime(path)
+        except OSError:
+            # the job was requeued, the result will still be delivered
+            pass
+
+
+def work(queue_dir, exit_when_empty=False, poll=POLL):
+    '''
+    Worker loop: claims jobs one at a time, runs fd3 in the directory of the
+    job while sending heartbeats, and writes the status to done/.
+    '''
+    import fd3_helper
+
+    _, claimed, done = queue_dirs(queue_dir)
+    host = socket.gethostname()
+    while True:
+        job = claim(queue_dir)
+        if job is None:
+            if exit_when_empty:
+                return
+            time.sleep(poll)
+            continue
+
+        path = os.path.join(claimed, job)
+        spec = read_json(path)
+        stop = threading.Event()
+        beat = threading.Thread(target=heartbeat, args=(path, stop))
+        beat.start()
+        try:
+            os.chdir(spec['cwd'])
+            status = fd3_helper.fd3(spec['name'], spec['timeout'],
+                                    spec['retries'], spec.get('convergence'))
+        except Exception as e:
+            status = {'name': spec['name'], 'returncode': None,
+                      'attempts': 0, 'runtime': 0., 'timed_out': False,
+                      'ok': False, 'error': repr(e),
+                      'outputs': []}
+        finally:
+            stop.set()
+            beat.join()
+
+        status['host'] = host
+        status['submitted'] = spec['submitted']
+        write_json(os.path.join(done, job), status)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='fd3 worker for a shared-filesystem work queue')
+    parser.add_argument('command', choices=['worker'])
+    parser.add_argument('queue_dir')
+    parser.add_argument('--exit-when-empty', action='store_true',
+                        help='stop when no jobs are pending')
+    args = parser.parse_args()
+
+    work(os.path.abspath(args.queue_dir), args.exit_when_empty)
+
+
+if __name__ == '__main__':
+    main()
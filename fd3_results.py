@@ -0,0 +1,239 @@
+import argparse
+import glob
+import json
+import multiprocessing as mp
+import time
+import numpy as np
+import fd3_helper
+import fd3_loader
+import fd3_progress
+'''
+v1.0
+18/10/2026
+Columnar store of the .res, .rvs and .log outputs of all segments of a run.
+The outputs are parsed once, in a process pool, and saved as one
+uncompressed .npz file that is memory-mapped when loaded:
+
+    segments     (n_segments,) names of the .in files
+    ranges       (n_segments, 2) ln(wavelength) range of every segment
+    res_lnw      (n_pixels,) ln(wavelength) of the residuals of all
+                 segments, one after the other
+    res          (n_pixels, n_epochs) residuals
+    res_offsets  (n_segments + 1,) first row of every segment in res
+    epochs       (n_epochs,) times of the epochs
+    rvs          (n_segments, n_epochs, n_columns) the .rvs columns after
+                 the time
+    chi2         (n_segments,) lowest chi2 in the .log file
+    fit          (n_segments, n_parameters) parameters of that chi2
+    iterations   (n_segments,) number of progress lines in the .log file
+    metadata     JSON string
+
+Missing values are NaN. The queries below (rms_residual, rv_scatter,
+chi2_ranking) only use these arrays.
+
+    python fd3_results.py ingest 'sig_aql_split_*.in' --out run.results.npz
+    python fd3_results.py report run.results.npz
+
+Stores are named *.results.npz (fd3_loader.RESULTS_SUFFIX), so file2figure
+doesn't take them for stitched spectra.
+'''
+
+
+def parse_segment(name):
+    # the .res, .rvs and .log outputs of the segment of the .in file name
+    outputs = fd3_helper.fd3_outputs(name)
+    first = fd3_helper.read_in_file(name)[0]
+    segment = {'name': name, 'range': (float(first[1]), float(first[2])),
+               'res': None, 'rvs': None, 'fit': None, 'iterations': 0}
+
+    try:
+        res = np.array(fd3_loader.load_table(outputs[3]), ndmin=2)
+        if res.size:
+            segment['res'] = res
+    except (OSError, ValueError):
+        pass
+
+    try:
+        rvs = np.loadtxt(outputs[4], ndmin=2)
+        if rvs.size:
+            segment['rvs'] = rvs
+    except (OSError, ValueError):
+        pass
+
+    segment['fit'] = fd3_progress.best_fit(outputs[5])
+    try:
+        with open(outputs[5], 'r') as f:
+            segment['iterations'] = sum(
+                1 for line in f if fd3_progress.parse_progress(line))
+    except OSError:
+        pass
+
+    return segment
+
+
+def ingest(filenames, store, processes=None, metadata=None):
+    '''
+    Parses the outputs of the segments of the .in files filenames in a
+    process pool and saves them as one columnar store (see above).
+    Returns the store, as load_results would.
+    '''
+    filenames = sorted(filenames)
+    pool = mp.Pool(processes)
+    segments = pool.map(parse_segment, filenames)
+    pool.close()
+    pool.join()
+    n = len(segments)
+
+    # residuals of all segments one after the other
+    n_epochs = max([s['res'].shape[1] - 1 for s in segments
+                    if s['res'] is not None] +
+                   [len(s['rvs']) for s in segments if s['rvs'] is not None] +
+                   [0])
+    counts = np.array([0 if s['res'] is None else len(s['res'])
+                       for s in segments])
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    res_lnw = np.full(offsets[-1], np.nan)
+    res = np.full((offsets[-1], n_epochs), np.nan)
+    for k, segment in enumerate(segments):
+        if segment['res'] is not None:
+            rows = slice(offsets[k], offsets[k + 1])
+            res_lnw[rows] = segment['res'][:, 0]
+            res[rows, :segment['res'].shape[1] - 1] = segment['res'][:, 1:]
+
+    # radial velocities per segment and epoch; the epoch times are taken
+    # from the first segment that has them
+    n_columns = max([s['rvs'].shape[1] - 1 for s in segments
+                     if s['rvs'] is not None] + [0])
+    epochs = np.full(n_epochs, np.nan)
+    rvs = np.full((n, n_epochs, n_columns), np.nan)
+    for k, segment in enumerate(segments):
+        if segment['rvs'] is not None:
+            m, c = segment['rvs'].shape
+            rvs[k, :m, :c - 1] = segment['rvs'][:, 1:]
+            if np.isnan(epochs[:m]).all():
+                epochs[:m] = segment['rvs'][:, 0]
+
+    n_params = max([len(s['fit'][1]) for s in segments
+                    if s['fit'] is not None] + [0])
+    chi2 = np.full(n, np.nan)
+    fit = np.full((n, n_params), np.nan)
+    for k, segment in enumerate(segments):
+        if segment['fit'] is not None:
+            chi2[k] = segment['fit'][0]
+            fit[k, :len(segment['fit'][1])] = segment['fit'][1]
+
+    metadata = dict(metadata or {})
+    metadata.setdefault('created', time.strftime('%Y-%m-%d %H:%M:%S'))
+    data = {'segments': np.array(filenames, dtype=str),
+            'ranges': np.array([s['range'] for s in segments],
+                               dtype=float).reshape(n, 2),
+            'res_lnw': res_lnw, 'res': res, 'res_offsets': offsets,
+            'epochs': epochs, 'rvs': rvs, 'chi2': chi2, 'fit': fit,
+            'iterations': np.array([s['iterations'] for s in segments]),
+            'metadata': np.array(json.dumps(metadata))}
+    np.savez(store, **data)
+    return load_results(store)
+
+
+def load_results(store, mmap=True):
+    # the arrays of a store written by ingest, memory-mapped with mmap
+    if mmap:
+        data = fd3_loader.mmap_npz(store)
+    else:
+        with np.load(store) as npz:
+            data = {name: npz[name] for name in npz.files}
+    data['metadata'] = json.loads(str(data['metadata']))
+    return data
+
+
+def segment_index(results):
+    # the segment of every row of res
+    return np.repeat(np.arange(len(results['segments'])),
+                     np.diff(results['res_offsets']))
+
+
+def rms_residual(results, per_epoch=False):
+    '''
+    RMS of the residuals of every segment, over all epochs, or with
+    per_epoch an (n_segments, n_epochs) array.
+    '''
+    n = len(results['segments'])
+    index = segment_index(results)
+    squares = np.nan_to_num(np.asarray(results['res'])**2)
+    valid = ~np.isnan(results['res'])
+    if per_epoch:
+        sums = np.zeros((n, squares.shape[1]))
+        counts = np.zeros((n, squares.shape[1]))
+        np.add.at(sums, index, squares)
+        np.add.at(counts, index, valid)
+    else:
+        sums = np.bincount(index, weights=squares.sum(axis=1), minlength=n)
+        counts = np.bincount(index, weights=valid.sum(axis=1), minlength=n)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.sqrt(sums / counts)
+
+
+def rv_scatter(results, column=0):
+    '''
+    Mean and standard deviation over all segments of the radial velocities
+    in .rvs column column (0 is the first column after the time) of every
+    epoch.
+    '''
+    rvs = np.asarray(results['rvs'])[:, :, column]
+    with np.errstate(invalid='ignore'):
+        counts = np.sum(~np.isnan(rvs), axis=0)
+        mean = np.nansum(rvs, axis=0) / counts
+        std = np.sqrt(np.nansum((rvs - mean)**2, axis=0) / counts)
+    return mean, std
+
+
+def chi2_ranking(results):
+    # indices of the segments from lowest to highest chi2, missing last
+    chi2 = np.asarray(results['chi2'])
+    return np.argsort(np.where(np.isnan(chi2), np.inf, chi2), kind='stable')
+
+
+def report(results):
+    # prints the chi2 ranking with the RMS residual of every segment, and
+    # the RV scatter of every epoch
+    rms = rms_residual(results)
+    print('{:>4}  {:30s}  {:>14}  {:>12}  {:>6}'.format(
+        'rank', 'segment', 'chi2', 'rms res', 'lines'))
+    for rank, k in enumerate(chi2_ranking(results)):
+        print('{:4d}  {:30s}  {:14.6g}  {:12.6g}  {:6d}'.format(
+            rank + 1, results['segments'][k], results['chi2'][k], rms[k],
+            int(results['iterations'][k])))
+
+    if results['rvs'].shape[2]:
+        print('\n{:>16}  {:>12}  {:>12}'.format('epoch', 'mean rv',
+                                                  'scatter'))
+        for epoch, mean, std in zip(results['epochs'],
+                                    *rv_scatter(results)):
+            print('{:16.6f}  {:12.6g}  {:12.6g}'.format(epoch, mean, std))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Columnar store of fd3 segment outputs')
+    commands = parser.add_subparsers(dest='command')
+    command = commands.add_parser('ingest')
+    command.add_argument('infiles', help="glob of the segment .in files")
+    command.add_argument('--out',
+                         default='fd3' + fd3_loader.RESULTS_SUFFIX)
+    command.add_argument('--processes', type=int, default=None)
+    command = commands.add_parser('report')
+    command.add_argument('store')
+    args = parser.parse_args()
+
+    if args.command == 'ingest':
+        filenames = glob.glob(args.infiles)
+        ingest(filenames, args.out, args.processes)
+        print("{} segments stored in '{}'".format(len(filenames), args.out))
+    elif args.command == 'report':
+        report(load_results(args.store))
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
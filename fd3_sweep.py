@@ -0,0 +1,233 @@
+import argparse
+import glob
+import itertools
+import os
+import numpy as np
+import fd3_helper
+import fd3_index
+import fd3_progress
+'''
+v1.0
+18/10/2026
+Parameter sweeps over the starting values of fd3. For every combination of
+the swept parameters (a grid, or random draws) a variant of every segment
+.in file is written, the whole segment x variant matrix is run through
+run_fd3 (largest jobs first, with the result cache), and the final chi2 and
+fitted parameters of every run are collected from the .log and .res files
+into one table. The variants are written to a sweep directory next to the
+segments (<segment>_pNN.in and its outputs), where globs of the segments
+don't find them.
+
+Parameters that can be swept:
+    period, t0, e, omega, k1, k2, domega   orbit line (starting values)
+    <element>_step                         their simplex step sizes
+    lf_a, lf_b                             light factors of all epochs
+
+    python fd3_sweep.py --in 'sig_aql_split_*.in' --grid k1=150,160,170 \
+        --random e=uniform:0:0.1 --draws 10
+'''
+
+SWEEP_DIR = 'sweep'
+
+
+def render_variant(lines, values, base):
+    '''
+    Text of an .in file with the parameters in values changed and all
+    outputs named after base.
+    '''
+    lines = list(lines)
+    first, epochs, orbit, last = fd3_helper.in_layout(lines)
+
+    orbitline = lines[orbit].split()
+    for i, element in enumerate(fd3_helper.ORBIT_ELEMENTS):
+        if element in values:
+            orbitline[2 * i] = repr(float(values[element]))
+        if element + '_step' in values:
+            orbitline[2 * i + 1] = repr(float(values[element + '_step']))
+    lines[orbit] = '  '.join(orbitline) + '\n'
+
+    for i in epochs:
+        epoch = lines[i].split()
+        if 'lf_a' in values:
+            epoch[3] = repr(float(values['lf_a']))
+        if 'lf_b' in values:
+            epoch[4] = repr(float(values['lf_b']))
+        lines[i] = ' '.join(epoch) + '\n'
+
+    firstline = lines[first].split()
+    firstline[3] = base + '_used.obs'
+    lines[first] = '  '.join(firstline) + '\n'
+
+    lastline = lines[last].split()
+    lastline[3:7] = [base + ext for ext in ('.mod', '.res', '.rvs', '.log')]
+    lines[last] = '  '.join(lastline) + '\n'
+
+    return ''.join(lines)
+
+
+def grid_points(grid):
+    # every combination of the values in grid ({name: [values]})
+    names = sorted(grid)
+    return [dict(zip(names, combination)) for combination in
+            itertools.product(*(grid[name] for name in names))]
+
+
+def random_points(distributions, n, seed=None):
+    '''
+    n random draws of the parameters in distributions, {name: (kind, a, b)}
+    with kind 'uniform' (between a and b) or 'normal' (mean a, sigma b).
+    '''
+    rng = np.random.default_rng(seed)
+    draws = {}
+    for name, (kind, a, b) in distributions.items():
+        if kind == 'uniform':
+            draws[name] = rng.uniform(a, b, n)
+        elif kind == 'normal':
+            draws[name] = rng.normal(a, b, n)
+        else:
+            raise ValueError("unknown distribution '{}'".format(kind))
+    return [{name: draws[name][i] for name in draws} for i in range(n)]
+
+
+def write_variants(infiles, points):
+    '''
+    Writes a variant of every .in file for every parameter point, in
+    SWEEP_DIR next to it. Returns a list of (in file, segment, point number,
+    point).
+    '''
+    digits = len(str(len(points)))
+    variants = []
+    for segment in infiles:
+        with open(segment, 'r') as f:
+            lines = f.readlines()
+        directory = os.path.join(os.path.dirname(segment), SWEEP_DIR)
+        os.makedirs(directory, exist_ok=True)
+        stem = os.path.join(directory, os.path.basename(segment)[:-3])
+        for p, point in enumerate(points):
+            base = '{}_p{:0{}d}'.format(stem, p + 1, digits)
+            with open(base + '.in', 'w') as f:
+                f.write(render_variant(lines, point, base))
+            variants.append((base + '.in', segment, p + 1, point))
+    return variants
+
+
+def read_fit(status):
+    '''
+    Final chi2 and fitted parameters of a finished run, from the last
+    progress line of its .log file, and the RMS of its residuals (.res).
+    '''
+    result = {'chi2': None, 'fit': [], 'rms_res': None}
+    try:
+        with open(status['outputs'][5], 'r') as f:
+            lines = [line for line in f if fd3_progress.parse_progress(line)]
+        if lines:
+            fields = lines[-1].split()
+            result['chi2'] = float(fields[2])
+            result['fit'] = [float(x) for x in fields[3:]]
+    except (OSError, ValueError):
+        pass
+    try:
+        res = fd3_helper.load_table(status['outputs'][3])
+        result['rms_res'] = float(np.sqrt(np.mean(res[:, 1:]**2)))
+    except (OSError, ValueError, IndexError):
+        pass
+    return result
+
+
+def sweep(infiles, points, table='sweep_results.csv', **run_options):
+    '''
+    Runs every .in file in infiles for every parameter point (a list of
+    dicts, see grid_points and random_points) and writes the results to
+    table. run_options are passed to fd3_helper.run_fd3. Returns the rows
+    of the table.
+    '''
+    variants = write_variants(infiles, points)
+    print("{} segments x {} parameter sets = {} runs".format(
+        len(infiles), len(points), len(variants)))
+    # recorded in the run index, so clean() removes the variants
+    jobs = [v[0] for v in variants]
+    run_id = fd3_helper.index_run(None, None, jobs, obs_is_slice=False)
+    statuses = {status['name']: status for status in
+                fd3_helper.run_fd3(jobs, run_id=run_id, **run_options)}
+    db = fd3_index.connect()
+    fd3_index.finish_run(db, run_id)
+    db.close()
+
+    names = sorted(set(name for point in points for name in point))
+    rows = []
+    for name, segment, p, point in variants:
+        status = statuses.get(name, {'ok': False, 'outputs': []})
+        row = {'segment': segment, 'set': p, 'ok': status['ok']}
+        row.update((key, point.get(key)) for key in names)
+        if status['ok']:
+            row.update(read_fit(status))
+        rows.append(row)
+
+    write_table(table, rows, names)
+    print("Results written to '{}'".format(table))
+    return rows
+
+
+def write_table(filename, rows, names):
+    # one line per run: segment, set, swept values, ok, chi2, rms_res, fit
+    n_fit = max([len(row.get('fit', [])) for row in rows] + [0])
+    columns = ['segment', 'set'] + names + ['ok', 'chi2', 'rms_res']
+    with open(filename, 'w') as f:
+        f.write(','.join(columns + ['fit_{}'.format(i + 1)
+                                    for i in range(n_fit)]) + '\n')
+        for row in rows:
+            fields = [str(row.get(column)) for column in columns]
+            fit = row.get('fit', [])
+            fields += [repr(x) for x in fit] + [''] * (n_fit - len(fit))
+            f.write(','.join(fields) + '\n')
+
+
+def parse_grid(options):
+    # ['k1=150,160', ...] -> {'k1': [150., 160.]}
+    grid = {}
+    for option in options:
+        name, values = option.split('=')
+        grid[name] = [float(x) for x in values.split(',')]
+    return grid
+
+
+def parse_random(options):
+    # ['e=uniform:0:0.1', ...] -> {'e': ('uniform', 0., 0.1)}
+    distributions = {}
+    for option in options:
+        name, spec = option.split('=')
+        kind, a, b = spec.split(':')
+        distributions[name] = (kind, float(a), float(b))
+    return distributions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Sweep fd3 starting values over all segments')
+    parser.add_argument('--in', dest='infiles', required=True,
+                        help="glob of the segment .in files")
+    parser.add_argument('--grid', action='append', default=[],
+                        metavar='NAME=V1,V2,...')
+    parser.add_argument('--random', action='append', default=[],
+                        metavar='NAME=uniform:LO:HI')
+    parser.add_argument('--draws', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--table', default='sweep_results.csv')
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--timeout', type=float, default=None)
+    args = parser.parse_args()
+
+    infiles = sorted(glob.glob(args.infiles))
+    points = grid_points(parse_grid(args.grid)) if args.grid else [{}]
+    if args.random:
+        draws = random_points(parse_random(args.random), args.draws,
+                              args.seed)
+        # every random draw combined with every grid point
+        points = [dict(point, **draw) for point in points for draw in draws]
+
+    sweep(infiles, points, args.table, processes=args.processes,
+          timeout=args.timeout)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+import json
+import os
+import resource
+import time
+from contextlib import contextmanager
+'''
+v1.0
+18/10/2026
+Instrumentation of the split -> fd3 -> stitch pipeline. Every stage records
+its wall time, CPU time and peak resident memory; fd3 jobs also record how
+long they waited in the pool queue and on which worker they ran.
+
+The records can be written as a JSON summary and as a Chrome trace
+(chrome://tracing, or https://ui.perfetto.dev), which shows the worker
+utilisation and the stragglers of the pool.
+
+    with fd3_trace.stage('setBounds'):
+        setBounds(...)
+    fd3_trace.TRACER.write_summary('fd3_run_summary.json')
+'''
+
+
+def _read_hwm():
+    # peak resident memory of this process in bytes, since the last reset
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _reset_hwm():
+    # Linux can reset the peak memory counter, so every stage gets its own
+    # peak. Elsewhere the peak is the high-water mark of the process.
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def child_usage():
+    # CPU time and peak memory of the waited-for child processes
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime, usage.ru_maxrss * 1024
+
+
+class Tracer(object):
+    """
+    Collects the spans of one run. A span is a dict with a name, category,
+    start time (s since the epoch), wall and CPU time (s), peak memory
+    (bytes), process and thread ids, and extra arguments.
+    """
+
+    def __init__(self):
+        self.spans = []
+        self._open = []
+
+    def clear(self):
+        self.spans = []
+        self._open = []
+
+    @contextmanager
+    def stage(self, name, category='stage', **args):
+        # the peak of the stages that are still running has to be read
+        # before the counter is reset for this one
+        hwm = _read_hwm()
+        for span in self._open:
+            span['peak_rss'] = max(span['peak_rss'], hwm)
+        _reset_hwm()
+
+        span = {'name': name, 'category': category, 'start': time.time(),
+                'pid': os.getpid(), 'tid': 0, 'peak_rss': 0, 'args': args}
+        self._open.append(span)
+        cpu = time.process_time()
+        tic = time.perf_counter()
+        try:
+            yield span
+        finally:
+            span['wall'] = time.perf_counter() - tic
+            span['cpu'] = time.process_time() - cpu
+            hwm = _read_hwm()
+            for other in self._open:
+                other['peak_rss'] = max(other['peak_rss'], hwm)
+            self._open.remove(span)
+            self.spans.append(span)
+
+    def add_job(self, status):
+        '''
+        Records an fd3 job from the status returned by fd3_helper.fd3, as a
+        'queue' span (submitted -> started) and a 'fd3' span (started ->
+        finished) on the thread of its worker.
+        '''
+        if 'started' not in status:
+            return
+        args = {key: status[key] for key in
+                ('returncode', 'attempts', 'timed_out', 'cached')
+                if key in status}
+        self.spans.append({
+            'name': status['name'], 'category': 'queue',
+            'start': status['submitted'],
+            'wall': status['started'] - status['submitted'], 'cpu': 0.,
+            'peak_rss': 0, 'pid': os.getpid(), 'tid': status['worker'],
+            'args': {}})
+        self.spans.append({
+            'name': status['name'], 'category': 'fd3',
+            'start': status['started'],
+            'wall': status['finished'] - status['started'],
+            'cpu': status['cpu'], 'peak_rss': status['peak_rss'],
+            'pid': os.getpid(), 'tid': status['worker'], 'args': args})
+
+    def summary(self):
+        # totals per stage name, and the individual fd3 jobs
+        stages = {}
+        for span in self.spans:
+            if span['category'] != 'stage':
+                continue
+            total = stages.setdefault(span['name'], {
+                'count': 0, 'wall': 0., 'cpu': 0., 'peak_rss': 0})
+            total['count'] += 1
+            total['wall'] += span['wall']
+            total['cpu'] += span['cpu']
+            total['peak_rss'] = max(total['peak_rss'], span['peak_rss'])
+
+        queue = {span['name']: span['wall'] for span in self.spans
+                 if span['category'] == 'queue'}
+        jobs = [{'name': span['name'], 'queue_wait': queue.get(span['name']),
+                 'run': span['wall'], 'cpu': span['cpu'],
+                 'peak_rss': span['peak_rss'], 'worker': span['tid'],
+                 **span['args']}
+                for span in self.spans if span['category'] == 'fd3']
+        jobs.sort(key=lambda job: job['run'], reverse=True)
+        return {'stages': stages, 'jobs': jobs}
+
+    def write_summary(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def write_chrome_trace(self, filename):
+        # complete ('X') events, times in microseconds since the first span
+        if not self.spans:
+            t0 = 0.
+        else:
+            t0 = min(span['start'] for span in self.spans)
+        events = []
+        for span in self.spans:
+            args = dict(span['args'], cpu=span['cpu'],
+                        peak_rss=span['peak_rss'])
+            events.append({
+                'name': span['name'], 'cat': span['category'], 'ph': 'X',
+                'ts': (span['start'] - t0) * 1e6, 'dur': span['wall'] * 1e6,
+                'pid': span['pid'], 'tid': span['tid'], 'args': args})
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+TRACER = Tracer()
+stage = TRACER.stage
@@ -0,0 +1,226 @@
+import argparse
+import glob
+import math
+import os
+import numpy as np
+import fd3_helper
+from fd3_loader import load_table
+'''
+v1.0
+18/10/2026
+Autotuner for the number of segments and their overlap. A few probe
+segments of different pixel counts are cut from the master .in/.obs files
+and run through fd3 one at a time, and a model of the fd3 run time,
+
+    t(n) = a + b * n**c      (n pixels)
+
+is fitted to their run times (at least 3 probes must succeed, for the 3
+parameters). With k segments of equal cost and the
+recommended overlap, the expected wall-clock time on N cores is
+
+    ceil(k / N) * t(n_total / k + n_overlap)
+
+and the k with the lowest time (the fewest segments within 2% of it) is
+recommended. The overlap is the largest Doppler shift of the orbit on the
+.in file (K1, K2 and e) at the red end, doubled, and at least
+MIN_OVERLAP_PIXELS pixels, so that the edges that fd3 can't constrain stay
+out of the stitched spectrum.
+
+The recommendation is written as a splits file with balanced_splits, for
+setBounds with the recommended overlap:
+
+    python fd3_tune.py sig_aql.in --cores 16
+'''
+
+C = 299792.458  # km/s
+MIN_OVERLAP_PIXELS = 20
+PROBE_FRACTIONS = (1 / 64., 1 / 32., 1 / 16., 1 / 8.)
+
+
+def fit_model(pixels, runtimes, exponents=np.linspace(0.5, 2.5, 81)):
+    '''
+    Fits t(n) = a + b * n**c with a, b >= 0 to the run times of the probes.
+    Returns (a, b, c). Raises ValueError with fewer than 3 probes, which
+    can't constrain the 3 parameters.
+    '''
+    if len(pixels) < 3:
+        raise ValueError("{} successful probe runs of fd3, at least 3 are "
+                         "needed for the run time model".format(len(pixels)))
+    pixels = np.asarray(pixels, dtype=float)
+    runtimes = np.asarray(runtimes, dtype=float)
+    best = None
+    for c in exponents:
+        x = pixels**c
+        # least squares for a and b, clipped to non-negative values
+        b = max(np.polyfit(x, runtimes, 1)[0], 0.)
+        a = max(np.mean(runtimes - b * x), 0.)
+        if b == 0.:
+            b = np.mean(runtimes - a) / np.mean(x)
+        error = np.sum((a + b * x - runtimes)**2)
+        if best is None or error < best[0]:
+            best = (error, a, b, c)
+    return best[1:]
+
+
+def predict(model, pixels):
+    a, b, c = model
+    return a + b * np.asarray(pixels, dtype=float)**c
+
+
+def recommend_overlap(infile, pixel_step):
+    '''
+    Overlap (in Å, per side, as setBounds takes it) for the .in file infile:
+    twice the largest Doppler shift of the orbit at the red end of the
+    range, and at least MIN_OVERLAP_PIXELS pixels of pixel_step (in
+    ln(wavelength)).
+    '''
+    lines = fd3_helper.read_in_file(infile)
+    upper = math.exp(float(lines[0][2]))
+    orbit = [float(x) for x in lines[-2][0::2]]
+    e, k1, k2 = orbit[2], orbit[4], orbit[5]
+    shift = max(abs(k1), abs(k2)) * (1 + abs(e)) / C * upper
+    overlap = max(2 * shift, MIN_OVERLAP_PIXELS * pixel_step * upper / 2)
+    return math.ceil(overlap * 10) / 10.
+
+
+def makespan(model, n_pixels, n_segments, cores, overlap_pixels):
+    # expected wall-clock time of n_segments equal segments on cores
+    per_segment = n_pixels / n_segments + overlap_pixels
+    return math.ceil(n_segments / cores) * float(predict(model, per_segment))
+
+
+def probe(infile, fractions=PROBE_FRACTIONS, timeout=None):
+    '''
+    Runs fd3 on probe segments that cover the given fractions of the
+    ln(wavelength) range of infile, one at a time. Returns their pixel
+    counts and run times (only of the runs that succeeded). The probe files
+    are removed afterwards. Raises ValueError when there is no fd3 binary.
+    '''
+    if len(glob.glob('fd3')) == 0:
+        raise ValueError("fd3 not found")
+
+    with open(infile, 'r') as f:
+        lines = f.readlines()
+    first, epochs, orbit, last = fd3_helper.in_layout(lines)
+    firstline = lines[first].split()
+    obsfile, lnmin, lnmax = firstline[0], float(firstline[1]), \
+        float(firstline[2])
+
+    stem = infile[:-3] + '_probe_{}'
+    names = [stem.format(k + 1) for k in range(len(fractions))]
+    ranges = [(lnmin, lnmin + fraction * (lnmax - lnmin))
+              for fraction in fractions]
+    fd3_helper.write_obs_slices(obsfile, ranges, [name + '.obs'
+                                                  for name in names])
+
+    pixels = []
+    runtimes = []
+    for name, (lo, hi) in zip(names, ranges):
+        probe_lines = list(lines)
+        probe_lines[first] = '  '.join(
+            [name + '.obs', repr(lo), repr(hi), name + '_used.obs'] +
+            firstline[4:]) + '\n'
+        lastline = lines[last].split()
+        lastline[3:7] = [name + ext for ext in ('.mod', '.res', '.rvs',
+                                               '.log')]
+        probe_lines[last] = '  '.join(lastline) + '\n'
+        with open(name + '.in', 'w') as f:
+            f.writelines(probe_lines)
+
+        status = fd3_helper.fd3(name + '.in', timeout=timeout)
+        n = fd3_helper.count_rows(name + '.obs')
+        print("probe {}: {} pixels, {:.2f} s{}".format(
+            name, n, status['runtime'], '' if status['ok'] else
+            ' (failed)'))
+        if status['ok']:
+            pixels.append(n)
+            runtimes.append(status['runtime'])
+
+        for output in [name + '.in', name + '.obs', name + '.progress'] + \
+                status['outputs']:
+            if os.path.exists(output):
+                os.remove(output)
+
+    return pixels, runtimes
+
+
+def recommend(infile, cores=None, model=None, min_segments=2,
+              max_segments=None, tolerance=0.02, timeout=None):
+    '''
+    Recommends the number of segments and the overlap for infile on cores
+    cores (default: all). model is (a, b, c) of the run time model, or
+    None to measure it with probe. Returns a dict with n_segments, overlap
+    (Å), the model and the expected wall-clock time.
+    '''
+    if cores is None:
+        cores = os.cpu_count() or 1
+    first = fd3_helper.read_in_file(infile)[0]
+    lnmin, lnmax = float(first[1]), float(first[2])
+    lnw = np.asarray(load_table(first[0])[:, 0])
+    n_pixels = int(np.count_nonzero((lnw >= lnmin) & (lnw <= lnmax)))
+    pixel_step = (lnmax - lnmin) / max(n_pixels - 1, 1)
+
+    if model is None:
+        model = fit_model(*probe(infile, timeout=timeout))
+
+    overlap = recommend_overlap(infile, pixel_step)
+    # an overlap of o Å on both sides of a split, in pixels
+    overlap_pixels = 2 * overlap / math.exp(lnmax) / pixel_step
+
+    if max_segments is None:
+        max_segments = max(n_pixels // (4 * MIN_OVERLAP_PIXELS),
+                           min_segments)
+    candidates = np.arange(min_segments, max_segments + 1)
+    times = np.array([makespan(model, n_pixels, k, cores, overlap_pixels)
+                      for k in candidates])
+    best = candidates[np.flatnonzero(times <= times.min() *
+                                     (1 + tolerance))[0]]
+
+    return {'n_segments': int(best), 'overlap': overlap,
+            'model': tuple(float(x) for x in model), 'cores': cores,
+            'pixels': n_pixels,
+            'expected_time': float(times[best - min_segments]),
+            'single_segment_time': float(predict(model, n_pixels))}
+
+
+def autotune(infile, cores=None, filename='splits.txt', **options):
+    '''
+    Runs recommend and writes the split points of the recommended number
+    of equal-cost segments to filename (see fd3_helper.balanced_splits).
+    Returns the recommendation; pass its overlap to setBounds.
+    '''
+    tuned = recommend(infile, cores, **options)
+    a, b, c = tuned['model']
+    print("Run time model: t = {:.3g} + {:.3g} * pixels**{:.2f} s".format(
+        a, b, c))
+    first = fd3_helper.read_in_file(infile)[0]
+    fd3_helper.balanced_splits(first[0], tuned['n_segments'],
+                               lower=math.exp(float(first[1])),
+                               upper=math.exp(float(first[2])),
+                               filename=filename)
+    print("Recommended: {} segments, overlap {} A on {} cores, "
+          "expected {:.1f} s (one segment: {:.1f} s)".format(
+              tuned['n_segments'], tuned['overlap'], tuned['cores'],
+              tuned['expected_time'], tuned['single_segment_time']))
+    print("saved {} split points to '{}'".format(
+        tuned['n_segments'] - 1, filename))
+    return tuned
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Recommend the number of fd3 segments and overlap')
+    parser.add_argument('infile', help='master .in file')
+    parser.add_argument('--cores', type=int, default=None)
+    parser.add_argument('--splits', default='splits.txt')
+    parser.add_argument('--timeout', type=float, default=None,
+                        help='timeout of every probe (s)')
+    args = parser.parse_args()
+    try:
+        autotune(args.infile, args.cores, args.splits, timeout=args.timeout)
+    except ValueError as error:
+        parser.exit(1, "### Autotuning failed: {} ###\n".format(error))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,14 @@
 import numpy as np
 import matplotlib.pyplot as plt
-from astropy.io import fits
+import argparse
 import glob
 import os
+import sys
+import time
+from fd3_loader import load_table, load_stitched, load_fits, \
+    RESULTS_SUFFIX
+import fd3_norm
+import fd3_pyramid
 
 '''
 v1.0
@@ -11,6 +17,15 @@ when using fd3
 
 v1.1
 Now gives the option to change directory first
+
+v1.2
+Text files are loaded through the binary cache in fd3_loader.py
+Opens the stitched .npz files written by fd3_helper.py
+Large spectra are drawn from cached min/max pyramids (see fd3_pyramid.py)
+FITS files are memory-mapped and scaled with fd3_norm.py, like .mod files;
+2-D stacks are plotted as one spectrum per row
+Batch mode renders PNGs of whole directory trees without interaction:
+    python file2figure.py --batch DIR [DIR ...] [--out OUTDIR]
 '''
 
 
@@ -38,7 +53,7 @@ def modfig():
 
     # Load data
     try:
-        mod = np.loadtxt(name).transpose()
+        mod = load_table(name).transpose()
         w = np.exp(mod[0])  # Convert back to wavelength space
 
         spec1 = mod[1]
@@ -60,17 +75,17 @@ def modfig():
         # Plot figure
         plt.figure()
 
-        plt.plot(w, spec2 / np.mean(spec2[0:20]), 'C0')
-        plt.plot(w, spec1 / np.mean(spec1[0:20]), 'C3')
-
+        scales = fd3_norm.window_scale([spec2, spec1], fd3_norm.EDGE)
+        fd3_pyramid.plot(name, w, [spec2, spec1],
+                         scales=list(scales[:, 0]),
+                         styles=['C0', 'C3'])
 
         plt.show()
     else:
         # Plot figure
         plt.figure()
 
-        plt.plot(w, spec2, 'C0')
-        plt.plot(w, spec1, 'C3')
+        fd3_pyramid.plot(name, w, [spec2, spec1], styles=['C0', 'C3'])
         plt.title('fd3 result; entire spectrum, 107 split points')
         plt.ylabel('normalised flux', fontdict=None, labelpad=None)
         plt.xlabel(r'$\lambda\,[\AA]$', fontdict=None, labelpad=None)
@@ -103,7 +118,7 @@ def txtfig():
 
     # Load data
     try:
-        txt = np.loadtxt(name).transpose()
+        txt = load_table(name).transpose()
         w = txt[0]
         if txt[0][0] < 1000:
             w = np.exp(txt[0])
@@ -120,16 +135,32 @@ def txtfig():
     # Plot figure
     plt.figure()
 
-    plt.plot(w, Intensity)
+    fd3_pyramid.plot(name, w, [Intensity])
 
     plt.show()
 
     typepicker()
 
 
-def scale_raw_spectra(w, f, window=[7500, 7550]):
-    inds = [i for i in range(len(w)) if window[0] <= w[i] <= window[1]]
-    return f / np.mean(f[inds])
+def scale_raw_spectra(w, f, window=fd3_norm.WINDOW):
+    return fd3_norm.scale_window(f, fd3_norm.window_slice_array(w, window))
+
+
+def fits_spectra(flux, start_w, delta_w):
+    '''
+    The spectra in FITS data (1-D, or a 2-D stack with one spectrum per
+    row) and their scale factors from the normalisation window, or None
+    for the scale factors when the window isn't in the spectra.
+    '''
+    if flux.ndim not in (1, 2):
+        raise ValueError("expected a spectrum or a 2-D stack of spectra, "
+                         "not {} dimensions".format(flux.ndim))
+    spectra = [flux] if flux.ndim == 1 else list(flux)
+    window = fd3_norm.window_slice(start_w, delta_w, flux.shape[-1])
+    if window.stop <= window.start:
+        return spectra, None
+    return spectra, [float(x) for x in
+                     fd3_norm.window_scale(flux, window).ravel()]
 
 
 def fitsfig():
@@ -153,24 +184,73 @@ def fitsfig():
 
     name = filenames[n]
 
-    # Load data
-    h = fits.open(name)
-    flux = h[0].data
+    # Load data; the wavelengths are only computed for the plotted points
+    flux, start_w, delta_w = load_fits(name)
+    n_points = flux.shape[-1]
+    w = fd3_pyramid.LogLinearGrid(start_w, delta_w, n_points)
+
+    try:
+        spectra, scales = fits_spectra(flux, start_w, delta_w)
+    except ValueError as e:
+        print("\n### {}. Returning to start... ###\n".format(e))
+        typepicker()
+    if scales is None:
+        print("\n### Normalisation window not in spectrum, "
+              "plotting raw flux ###\n")
+        scales = [1.] * len(spectra)
+
+    # Plot figure
+    plt.figure()
+
+    fd3_pyramid.plot(name, w, spectra, scales=scales)
+
+    plt.show()
 
-    n_points = h[0].header['NAXIS1']
-    start_w = h[0].header['CRVAL1']
-    delta_w = h[0].header['CDELT1']
+    typepicker()
+
+
+def npzfig():
+    # Select correct file
+    print('\nLoading filenames...')
+    # not the results stores of fd3_results.py
+    filenames = [name for name in glob.glob('*.npz')
+                 if not name.endswith(RESULTS_SUFFIX)]
+    filenames.sort()
+
+    if len(filenames) == 0:
+        print('No files of chosen filetype found.\n')
+        typepicker()
 
-    w = np.exp(np.linspace(start_w,
-                           start_w + (delta_w * (n_points - 1)),
-                           n_points))
+    for i in range(len(filenames)):
+        print(str(i) + ': ' + filenames[i])
 
-    scaled_f = scale_raw_spectra(w,flux)
+    n = int(input("Choose file: "))
+
+    if n not in range(len(filenames)):
+        print("\n### Invalid file chosen. Returning to start... ### \n")
+        typepicker()
+
+    name = filenames[n]
+
+    # Load data
+    try:
+        stitched = load_stitched(name)
+    except (KeyError, ValueError, OSError):
+        print("\n### This file format can't be handled ###\n")
+        typepicker()
+
+    w = np.exp(stitched['lnw'])
 
     # Plot figure
     plt.figure()
 
-    plt.plot(w, scaled_f)
+    fd3_pyramid.plot(name, w, [stitched['flux'][1], stitched['flux'][0]],
+                     styles=['C0', 'C3'])
+    if stitched['boundaries'] is not None:
+        for lo, hi in np.exp(stitched['boundaries'][1:]):
+            plt.axvline(lo, color='grey', alpha=0.3)
+    plt.ylabel('normalised flux', fontdict=None, labelpad=None)
+    plt.xlabel(r'$\lambda\,[\AA]$', fontdict=None, labelpad=None)
 
     plt.show()
 
@@ -179,12 +259,14 @@ def fitsfig():
 
 def typepicker():
     print("\nChoose filetype: \n0: .txt (2 columns)\n"
-          "1: .mod (3 columns)\n2: .fits\n\nPress 'q' to quit\n")
+          "1: .mod (3 columns)\n2: .fits\n3: .npz (stitched)\n\n"
+          "Press 'q' to quit\n")
     chosentype = input('-> ')
 
-    while chosentype not in ('0', '1', '2', 'q', 'h'):
+    while chosentype not in ('0', '1', '2', '3', 'q', 'h'):
         print("\nChoose filetype: \n0: .txt (2 columns)\n"
-              "1: .mod (3 columns)\n2: .fits\n\nPress 'q' to quit\n")
+              "1: .mod (3 columns)\n2: .fits\n3: .npz (stitched)\n\n"
+              "Press 'q' to quit\n")
         chosentype = input('-> ')
 
     if chosentype == '0':
@@ -193,6 +275,8 @@ def typepicker():
         modfig()
     elif chosentype == '2':
         fitsfig()
+    elif chosentype == '3':
+        npzfig()
     elif chosentype == 'q':
         raise SystemExit
     elif chosentype == 'h':
@@ -218,6 +302,10 @@ def help():
 
         - Should always work (not sure though)
 
+    .npz files
+
+        - Stitched spectra saved by fd3_helper.py.
+
         """)
 
 
@@ -261,6 +349,128 @@ def path_chooser():
     return os.getcwd()
 
 
+BATCH_TYPES = ('.mod', '.txt', '.fits', '.npz')
+
+
+def load_for_plot(name):
+    '''
+    Loads a file for a quick-look plot without asking anything. Returns the
+    wavelengths, the spectra to plot, their scale factors and line styles.
+    '''
+    if name.endswith('.mod'):
+        mod = load_table(name).transpose()
+        if mod.shape[0] != 3:
+            raise ValueError("expected 3 columns")
+        return np.exp(mod[0]), [mod[2], mod[1]], [1., 1.], ['C0', 'C3']
+    elif name.endswith('.txt'):
+        txt = load_table(name).transpose()
+        if txt.shape[0] != 2:
+            raise ValueError("expected 2 columns")
+        w = txt[0]
+        if txt[0][0] < 1000:
+            w = np.exp(txt[0])
+        return w, [txt[1]], [1.], ['C0']
+    elif name.endswith('.fits'):
+        flux, start_w, delta_w = load_fits(name)
+        spectra, scales = fits_spectra(flux, start_w, delta_w)
+        return (fd3_pyramid.LogLinearGrid(start_w, delta_w, flux.shape[-1]),
+                spectra, scales or [1.] * len(spectra),
+                ['C{}'.format(i % 10) for i in range(len(spectra))])
+    elif name.endswith('.npz'):
+        stitched = load_stitched(name)
+        return (np.exp(stitched['lnw']),
+                [stitched['flux'][1], stitched['flux'][0]], [1., 1.],
+                ['C0', 'C3'])
+    raise ValueError("unknown file type")
+
+
+def render(name, pngname, width=1600, height=500):
+    # draws a quick-look figure of one file to a PNG, without pyplot, at
+    # about one plotted point per pixel of the image
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    w, ys, scales, styles = load_for_plot(name)
+    pyramids = fd3_pyramid.load_pyramid(name, ys)
+
+    dpi = 100
+    fig = Figure(figsize=(width / dpi, height / dpi), dpi=dpi)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    lo, hi = w[0], w[len(w) - 1]
+    for y, levels, scale, style in zip(ys, pyramids, scales, styles):
+        ax.plot(*fd3_pyramid.view(w, y, levels, lo, hi, width, scale), style)
+    ax.set_xlim(lo, hi)
+    ax.set_title(os.path.basename(name))
+    ax.set_xlabel(r'$\lambda\,[\AA]$')
+    fig.savefig(pngname)
+
+
+def render_job(job):
+    # pool worker: returns the file, its render time and an error (or None)
+    name, pngname = job
+    tic = time.time()
+    try:
+        render(name, pngname)
+        error = None
+    except Exception as e:
+        error = repr(e)
+    return name, time.time() - tic, error
+
+
+def find_files(directories, outdir=None):
+    '''
+    All files of the plottable types below the directories, with the name of
+    their PNG (next to the file, or in the same tree below outdir). Files
+    whose PNG is newer than the file itself are left out.
+    '''
+    jobs = []
+    for directory in directories:
+        for root, dirs, files in os.walk(directory):
+            dirs.sort()
+            for filename in sorted(files):
+                if not filename.endswith(BATCH_TYPES) or \
+                        filename.endswith(RESULTS_SUFFIX):
+                    continue
+                name = os.path.join(root, filename)
+                if outdir is None:
+                    pngname = name + '.png'
+                else:
+                    pngname = os.path.join(
+                        outdir, os.path.relpath(name, directory) + '.png')
+                if (os.path.exists(pngname) and
+                        os.path.getmtime(pngname) >= os.path.getmtime(name)):
+                    continue
+                jobs.append((name, pngname))
+    return jobs
+
+
+def batch(directories, outdir=None, processes=None):
+    '''
+    Renders PNGs of every .mod, .txt, .fits and .npz file below the
+    directories in a process pool, skipping files that are up to date, and
+    reports the render time of every file.
+    '''
+    import multiprocessing as mp
+
+    jobs = find_files(directories, outdir)
+    print("{} files to render".format(len(jobs)))
+    for _, pngname in jobs:
+        os.makedirs(os.path.dirname(os.path.abspath(pngname)), exist_ok=True)
+
+    tic = time.time()
+    failed = 0
+    with mp.Pool(processes) as pool:
+        for name, runtime, error in pool.imap_unordered(render_job, jobs):
+            if error is None:
+                print("{:7.2f} s  {}".format(runtime, name))
+            else:
+                failed += 1
+                print("{:7.2f} s  {}  FAILED: {}".format(runtime, name, error))
+    print("Rendered {} files in {:.1f} s ({} failed)".format(
+        len(jobs) - failed, time.time() - tic, failed))
+
+
 def main():
     dirchoice = input("\nWork in current directory? (Y/N): ")
     while dirchoice not in ('Y', 'y', 'N', 'n', 'h'):
@@ -277,10 +487,22 @@ def main():
         typepicker()
 
 
-print("""
-### file2fig v1.1 ###
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        parser = argparse.ArgumentParser(
+            description='Render quick-look PNGs of all files in a tree')
+        parser.add_argument('--batch', nargs='+', metavar='DIR',
+                            required=True)
+        parser.add_argument('--out', help='directory for the PNGs '
+                            '(default: next to the files)')
+        parser.add_argument('--processes', type=int, default=None)
+        args = parser.parse_args()
+        batch(args.batch, args.out, args.processes)
+    else:
+        print("""
+### file2fig v1.2 ###
 
 Press 'h' at any prompt for help concerning
 formatting expectations for data files. """)
 
-main()
+        main()